@@ -0,0 +1,254 @@
+"""Time-ordered backtest of the BID model over monthly windows.
+
+Unlike train_lgb_cv (shuffled StratifiedKFold), every window trains on the
+months before its test months only. The windows are either expanding (all
+months so far) or rolling (the last train_months months). With
+warm_start=True (expanding windows only) each window continues boosting the
+previous window's booster (init_model) on the newly added months with
+warm_rounds extra trees instead of refitting n_estimators trees on the whole
+window; full retrains are run next to it for the comparison. The encoding
+(fit_preprocessor) is fit on training rows only, never on test months.
+
+Functions:
+- monthly_windows(dates, mode='expanding', train_months=6, test_months=1, step_months=1) -> list of window dicts
+- run_backtest(df, features, date_column='応募承諾週', target='BID', mode='expanding', train_months=6, test_months=1,
+  step_months=1, params=None, warm_start=True, warm_rounds=None, compare_full=True, manual_threshold=0.12,
+  n_jobs=1) -> (timeline DataFrame, last window's booster)
+- backtest_summary(timeline) -> dict of mean AUC/F1 and training seconds saved by warm starts
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from sklearn.metrics import roc_auc_score, f1_score
+
+from scripts.instrument import instrumented, span
+from scripts.model import fit_preprocessor, native_train_params, transform_features
+from scripts.utils import resolve_n_jobs
+
+
+DEFAULT_PARAMS = dict(objective='binary', metric='auc', random_state=42,
+                      n_estimators=317, learning_rate=0.03, num_leaves=31)
+
+
+def monthly_windows(dates: pd.Series, mode='expanding', train_months=6, test_months=1, step_months=1):
+    """Split the months spanned by dates into (train, test) windows.
+
+    Each window tests test_months months; training covers every earlier month
+    (mode='expanding') or the train_months months just before the test months
+    (mode='rolling'). The first window has train_months training months and
+    later windows move by step_months.
+    Returns dicts with window, train_start, train_end, test_start, test_end
+    (monthly Periods, inclusive).
+    """
+    if mode not in ('expanding', 'rolling'):
+        raise ValueError(f"mode must be 'expanding' or 'rolling', got {mode!r}")
+    months = pd.to_datetime(dates).dropna().dt.to_period('M')
+    if months.empty:
+        return []
+    first, last = months.min(), months.max()
+
+    windows = []
+    test_start = first + train_months
+    while test_start <= last:
+        windows.append({
+            'window': len(windows),
+            'train_start': first if mode == 'expanding' else test_start - train_months,
+            'train_end': test_start - 1,
+            'test_start': test_start,
+            'test_end': min(test_start + test_months - 1, last),
+        })
+        test_start += step_months
+    return windows
+
+
+def _fit_window(X, Y, train_idx, categorical_features, params, num_boost_round, init_model=None):
+    dataset_params, train_params, _ = native_train_params(params)
+    dataset_params = {'verbose': -1, **dataset_params}
+    start = time.perf_counter()
+    train_set = lgb.Dataset(X.iloc[train_idx], Y.iloc[train_idx], params=dataset_params,
+                            categorical_feature=[c for c in categorical_features if c in X.columns])
+    booster = lgb.train(train_params, train_set, num_boost_round=num_boost_round, init_model=init_model)
+    return booster, time.perf_counter() - start
+
+
+def _evaluate(booster, X, Y, test_idx, manual_threshold):
+    Y_test = Y.iloc[test_idx]
+    proba = booster.predict(X.iloc[test_idx])
+    # A test month without both classes has no AUC
+    auc = roc_auc_score(Y_test, proba) if Y_test.nunique() == 2 else np.nan
+    f1 = f1_score(Y_test, (proba >= manual_threshold).astype(int), zero_division=0)
+    return auc, f1
+
+
+def _run_chain(X, Y, windows, categorical_features, params, n_estimators, warm_rounds, manual_threshold):
+    """Train the windows in order, each continuing from the previous booster (init_model).
+
+    A warm-started window boosts on the rows its training months add to the
+    previous window's (the new month(s) of data): init_model re-scores the
+    training rows with the whole previous ensemble, so boosting on the full
+    window again would grow slower than a full retrain as trees accumulate.
+    """
+    results = []
+    booster = None
+    trained = np.zeros(len(X), dtype=bool)
+    for window in windows:
+        train_idx = window['train_idx'] if booster is None else window['train_idx'][~trained[window['train_idx']]]
+        with span('run_backtest.window', window=window['window'], rows_in=len(train_idx)):
+            if len(train_idx) or booster is None:
+                booster, seconds = _fit_window(X, Y, train_idx, categorical_features, params,
+                                               n_estimators if booster is None else warm_rounds, init_model=booster)
+            else:
+                seconds = 0.0
+        trained[train_idx] = True
+        auc, f1 = _evaluate(booster, X, Y, window['test_idx'], manual_threshold)
+        results.append({'booster': booster, 'trees': booster.current_iteration(), 'n_boosted': len(train_idx),
+                        'seconds': seconds, 'auc': auc, 'f1': f1})
+    return results
+
+
+def _run_full(df, features, Y, window, params, n_estimators, manual_threshold):
+    """Fit one window from scratch, with the encoding fit on its own training rows."""
+    train_idx, test_idx = window['train_idx'], window['test_idx']
+    with span('run_backtest.full_retrain', window=window['window'], rows_in=len(train_idx)):
+        preprocessor = fit_preprocessor(df.iloc[train_idx], features)
+        rows = np.concatenate([train_idx, test_idx])
+        X = transform_features(df.iloc[rows], preprocessor)
+        Y_window = Y.iloc[rows]
+        local_train_idx = np.arange(len(train_idx))
+        booster, seconds = _fit_window(X, Y_window, local_train_idx, list(preprocessor['categorical']),
+                                       params, n_estimators)
+    auc, f1 = _evaluate(booster, X, Y_window, np.arange(len(train_idx), len(rows)), manual_threshold)
+    return {'booster': booster, 'trees': booster.current_iteration(), 'n_boosted': len(window['train_idx']),
+            'seconds': seconds, 'auc': auc, 'f1': f1}
+
+
+@instrumented()
+def run_backtest(df: pd.DataFrame, features: list, date_column='応募承諾週', target='BID', mode='expanding',
+                 train_months=6, test_months=1, step_months=1, params=None, warm_start=True, warm_rounds=None,
+                 compare_full=True, manual_threshold=0.12, n_jobs=1):
+    """Train and evaluate the model on every monthly window of df (see monthly_windows).
+
+    date_column: '応募承諾週' or 'データ登録日'; rows without a date are left out.
+    Features are encoded with fit_preprocessor / transform_features fit on
+    training rows only: each full retrain fits its own window, the
+    warm-started chain fits the first window once so category codes stay the
+    same along it (categories first seen later are treated as missing).
+    warm_start needs mode='expanding': a rolling window drops old months,
+    which appending trees to the previous booster cannot forget.
+    Boosting runs a fixed number of rounds (the test months are never used
+    for early stopping): n_estimators for a fresh fit, warm_rounds (default
+    n_estimators // 10) per warm-started window.
+    The warm-started chain is sequential; the full retrains of compare_full
+    (or every window when warm_start=False) are independent and run on n_jobs
+    threads next to it, with cores // n_jobs LightGBM threads each. The first
+    window is a fresh fit either way, so its full retrain is not repeated.
+
+    Returns (timeline, booster): one timeline row per window with its dates,
+    sizes (n_boosted: rows the window's boosting ran on), auc / f1 /
+    train_seconds / trees, plus full_auc / full_f1 /
+    full_seconds / full_trees when warm_start and compare_full are set; and
+    the last window's booster. The warm-started windows only append trees, so
+    window w's model is the first timeline['trees'][w] iterations of it.
+    """
+    if warm_start and mode == 'rolling':
+        raise ValueError("warm_start=True needs mode='expanding'; use warm_start=False for rolling windows")
+    params = dict(DEFAULT_PARAMS if params is None else params)
+    _, _, n_estimators = native_train_params(params)
+    if warm_rounds is None:
+        warm_rounds = max(1, n_estimators // 10)
+
+    df = df[df[date_column].notna()].reset_index(drop=True)
+    Y = df[target].copy()
+    months = pd.to_datetime(df[date_column]).dt.to_period('M')
+
+    windows = []
+    for window in monthly_windows(months.dt.to_timestamp(), mode=mode, train_months=train_months,
+                                  test_months=test_months, step_months=step_months):
+        window['train_idx'] = np.flatnonzero(((months >= window['train_start'])
+                                              & (months <= window['train_end'])).to_numpy())
+        window['test_idx'] = np.flatnonzero(((months >= window['test_start'])
+                                             & (months <= window['test_end'])).to_numpy())
+        if len(window['train_idx']) and len(window['test_idx']):
+            windows.append(window)
+    if not windows:
+        raise ValueError(f'not enough months in {date_column} for train_months={train_months}')
+
+    full_windows = windows[1:] if warm_start else windows
+    if warm_start and not compare_full:
+        full_windows = []
+
+    n_workers = resolve_n_jobs(n_jobs)
+    if n_workers > 1:
+        params = {**params, 'n_jobs': max(1, (os.cpu_count() or 1) // n_workers)}
+
+    chain_args = None
+    if warm_start:
+        preprocessor = fit_preprocessor(df.iloc[windows[0]['train_idx']], features)
+        chain_args = (transform_features(df, preprocessor), Y, windows, list(preprocessor['categorical']),
+                      params, n_estimators, warm_rounds, manual_threshold)
+    full_args = [(df, features, Y, window, params, n_estimators, manual_threshold) for window in full_windows]
+    if n_workers > 1:
+        # LightGBM releases the GIL while training, so threads are enough here
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            chain = executor.submit(_run_chain, *chain_args) if warm_start else None
+            full_results = list(executor.map(lambda args: _run_full(*args), full_args))
+            chain_results = chain.result() if warm_start else None
+    else:
+        chain_results = _run_chain(*chain_args) if warm_start else None
+        full_results = [_run_full(*args) for args in full_args]
+
+    full_by_window = dict(zip([window['window'] for window in full_windows], full_results))
+    primary = chain_results if warm_start else full_results
+    if warm_start and compare_full:
+        full_by_window[windows[0]['window']] = chain_results[0]
+
+    rows = []
+    for window, result in zip(windows, primary):
+        test_idx = window['test_idx']
+        row = {
+            'window': window['window'],
+            'train_start': window['train_start'].to_timestamp(),
+            'train_end': window['train_end'].to_timestamp(how='end').normalize(),
+            'test_start': window['test_start'].to_timestamp(),
+            'test_end': window['test_end'].to_timestamp(how='end').normalize(),
+            'n_train': len(window['train_idx']),
+            'n_test': len(test_idx),
+            'test_positive_rate': Y.iloc[test_idx].mean(),
+            'auc': result['auc'],
+            'f1': result['f1'],
+            'n_boosted': result['n_boosted'],
+            'train_seconds': result['seconds'],
+            'trees': result['trees'],
+        }
+        if warm_start and compare_full:
+            full = full_by_window[window['window']]
+            row.update({'full_auc': full['auc'], 'full_f1': full['f1'],
+                        'full_seconds': full['seconds'], 'full_trees': full['trees']})
+        rows.append(row)
+
+    return pd.DataFrame(rows), primary[-1]['booster']
+
+
+def backtest_summary(timeline: pd.DataFrame) -> dict:
+    """Mean AUC / F1 over the windows and, with full retrains, the training time saved by warm starts."""
+    summary = {
+        'n_windows': len(timeline),
+        'auc_mean': timeline['auc'].mean(),
+        'f1_mean': timeline['f1'].mean(),
+        'train_seconds': timeline['train_seconds'].sum(),
+    }
+    if 'full_seconds' in timeline.columns:
+        full_seconds = timeline['full_seconds'].sum()
+        summary.update({
+            'full_auc_mean': timeline['full_auc'].mean(),
+            'full_f1_mean': timeline['full_f1'].mean(),
+            'full_seconds': full_seconds,
+            'seconds_saved': full_seconds - summary['train_seconds'],
+            'saving_ratio': 1 - summary['train_seconds'] / full_seconds if full_seconds > 0 else np.nan,
+        })
+    return summary
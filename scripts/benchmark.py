@@ -0,0 +1,231 @@
+"""Stage-level benchmarks on synthetic data.
+
+Times every stage of the pipeline (and the test / training stages that
+consume df_final) on generate_sheets data, records the peak traced memory,
+and stores the numbers as a JSON baseline so regressions between versions
+show up as ratios.
+
+Functions:
+- run_benchmarks(scale=10_000, stages=None, seed=0, vectorized=False, compact=False, n_trials=5, repeat=1,
+  trace_memory=True) -> DataFrame (one row per stage)
+- save_baseline(results, path, **meta) / load_baseline(path)
+- compare_to_baseline(results, baseline, tolerance=0.25) -> DataFrame with ratios and a regression flag
+
+BASELINE_PATH (bench/baseline.json) is the committed reference: the default
+scale (10k 応募 rows, seed 0, 5 Optuna trials), best of 3 runs, with the
+library versions it was measured on. Timings only compare on similar
+hardware, so re-create it with --save when the machine changes.
+
+Command line:
+    python -m scripts.benchmark --repeat 3 --compare
+    python -m scripts.benchmark --repeat 3 --save bench/baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from scripts.pipeline import FEATURES_TO_TEST, MODEL_FEATURES
+from scripts.synthetic import generate_sheets
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench', 'baseline.json')
+
+STAGES = ['preprocess_merge', 'add_time_deltas', 'create_features', 'finalize_dataset',
+          'run_mannwhitney_tests', 'train_lgb_cv', 'optuna_search']
+
+
+def _measure(fn, repeat, trace_memory):
+    """Best wall time of `repeat` untraced runs, plus the peak traced memory of one extra run."""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - start)
+
+    peak_mb = np.nan
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+    return result, min(seconds), peak_mb
+
+
+def _shape(result):
+    if isinstance(result, pd.DataFrame):
+        return result.shape
+    if isinstance(result, list):
+        return len(result), np.nan
+    return np.nan, np.nan
+
+
+def run_benchmarks(scale=10_000, stages=None, seed=0, vectorized=False, compact=False, n_trials=5, repeat=1,
+                   trace_memory=True):
+    """Run the selected stages on generate_sheets(scale) data.
+
+    Each stage gets the previous stage's output, so a subset of stages still
+    runs the earlier ones (untimed) to build its input. The model stages use
+    prepare_lgb_data on MODEL_FEATURES (untimed), and optuna_search runs
+    n_trials trials.
+    Returns one row per timed stage: stage, seconds, peak_mb (traced Python
+    and NumPy allocations), rows_out and cols_out.
+    """
+    from scripts.feature_engineering import create_features
+    from scripts.preprocessing import add_time_deltas, finalize_dataset, preprocess_merge
+
+    stages = STAGES if stages is None else list(stages)
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f'unknown stages: {sorted(unknown)}')
+
+    df_mendan, df_oubo, df_seiyaku = generate_sheets(n_oubo=scale, seed=seed)
+    state = {}
+
+    def run_u_test():
+        from scripts.u_test import run_mannwhitney_tests
+        from scripts.utils import split_by_cp
+        features = [f for f in FEATURES_TO_TEST if f in state['df_final'].columns]
+        return run_mannwhitney_tests(split_by_cp(state['df_final']), features)
+
+    def prepare_model_data():
+        from scripts.model import prepare_lgb_data
+        features = [f for f in MODEL_FEATURES if f in state['df_final'].columns]
+        return prepare_lgb_data(state['df_final'], features)
+
+    def run_train():
+        from scripts.model import train_lgb_cv
+        X, Y, categorical_features, _ = state['model_data']
+        return train_lgb_cv(X, Y, categorical_features, params={'n_estimators': 200, 'verbose': -1})
+
+    def run_optuna():
+        import optuna
+        from scripts.optuna_utils import optuna_search
+        optuna.logging.set_verbosity(optuna.logging.WARNING)
+        X, Y, categorical_features, _ = state['model_data']
+        return optuna_search(X, Y, categorical_features, n_trials=n_trials, random_state=seed)
+
+    steps = [
+        ('preprocess_merge', lambda: preprocess_merge(df_mendan, df_oubo, compact=compact), 'df_merge'),
+        ('add_time_deltas', lambda: add_time_deltas(state['df_merge'], df_mendan, df_oubo,
+                                                    vectorized=vectorized, compact=compact), 'df_deltas'),
+        ('create_features', lambda: create_features(state['df_deltas'], vectorized=vectorized, compact=compact),
+         'df_features'),
+        ('finalize_dataset', lambda: finalize_dataset(state['df_features'], df_mendan, df_oubo, df_seiyaku,
+                                                      compact=compact), 'df_final'),
+        ('run_mannwhitney_tests', run_u_test, None),
+        ('prepare_lgb_data', prepare_model_data, 'model_data'),
+        ('train_lgb_cv', run_train, None),
+        ('optuna_search', run_optuna, None),
+    ]
+
+    # Untimed steps (outputs of unselected stages) still run when a later selected stage needs them
+    last = max(position for position, (stage, _, _) in enumerate(steps) if stage in stages)
+    rows = []
+    for stage, fn, output in steps[:last + 1]:
+        if stage in stages:
+            result, seconds, peak_mb = _measure(fn, repeat, trace_memory)
+            rows_out, cols_out = _shape(result)
+            rows.append({'stage': stage, 'seconds': seconds, 'peak_mb': peak_mb,
+                         'rows_out': rows_out, 'cols_out': cols_out})
+        elif output is not None:
+            result = fn()
+        if output is not None:
+            state[output] = result
+
+    return pd.DataFrame(rows, columns=['stage', 'seconds', 'peak_mb', 'rows_out', 'cols_out'])
+
+
+def _environment():
+    versions = {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__}
+    for module in ['lightgbm', 'scipy', 'optuna']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return versions
+
+
+def save_baseline(results: pd.DataFrame, path: str, **meta):
+    """Write results as a JSON baseline, with library versions and any extra meta (scale, options)."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    payload = {
+        'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'environment': _environment(),
+        'meta': meta,
+        'stages': json.loads(results.set_index('stage').to_json(orient='index')),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+
+
+def load_baseline(path: str) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare_to_baseline(results: pd.DataFrame, baseline, tolerance=0.25) -> pd.DataFrame:
+    """Join results with a baseline (dict or path); regression = slower or bigger than 1 + tolerance."""
+    if isinstance(baseline, str):
+        baseline = load_baseline(baseline)
+    base = pd.DataFrame.from_dict(baseline['stages'], orient='index')[['seconds', 'peak_mb']]
+    base.columns = ['baseline_seconds', 'baseline_peak_mb']
+
+    comparison = results.set_index('stage')[['seconds', 'peak_mb']].join(base, how='left')
+    comparison['time_ratio'] = comparison['seconds'] / comparison['baseline_seconds']
+    comparison['memory_ratio'] = comparison['peak_mb'] / comparison['baseline_peak_mb']
+    comparison['regression'] = ((comparison['time_ratio'] > 1 + tolerance)
+                                | (comparison['memory_ratio'] > 1 + tolerance))
+    return comparison.reset_index()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--scale', type=int, default=10_000, help='number of 応募 rows (10k .. 10M)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vectorized', action='store_true')
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--n-trials', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run (tracemalloc)')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH,
+                        help='compare against a JSON baseline (default: the committed bench/baseline.json)')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(scale=args.scale, stages=args.stages, seed=args.seed, vectorized=args.vectorized,
+                             compact=args.compact, n_trials=args.n_trials, repeat=args.repeat,
+                             trace_memory=not args.no_memory)
+    print(results.to_string(index=False))
+
+    meta = dict(scale=args.scale, seed=args.seed, vectorized=args.vectorized, compact=args.compact,
+                n_trials=args.n_trials, repeat=args.repeat)
+    if args.compare:
+        baseline = load_baseline(args.compare)
+        different = {key: (value, baseline['meta'].get(key)) for key, value in meta.items()
+                     if key in baseline['meta'] and baseline['meta'][key] != value}
+        if different:
+            print(f'warning: options differ from the baseline (run, baseline): {different}')
+        comparison = compare_to_baseline(results, baseline, tolerance=args.tolerance)
+        print(comparison.to_string(index=False))
+    if args.save:
+        save_baseline(results, args.save, **meta)
+    if args.compare and comparison['regression'].any():
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,204 @@
+"""Capacity-constrained distribution of new candidates to CPs.
+
+Scores every (candidate, CP) pair, then solves the assignment over the
+positive-score edges as a sparse bipartite matching in which each CP is
+expanded into one column per capacity slot (scipy's
+min_weight_full_bipartite_matching), so the answer is integral by
+construction and each CP receives at most its capacity. The matching graph
+holds one entry per (edge, slot of the edge's CP), never the dense
+candidates x slots matrix; it is capped at MAX_SLOT_EDGES entries (use top_k
+to thin the edges of larger batches).
+
+Functions:
+- strength_score_matrix(df_candidates, strengths, cp_names=None, p_threshold=0.05) -> (csr_matrix, cp_names)
+- bid_probability_matrix(models, X_candidates, cp_codes, cp_column='担当CP') -> ndarray
+- assign_candidates(scores, capacities, top_k=None, fill_unassigned=True) -> ndarray of CP positions (-1 = none)
+- distribute_candidates(df_candidates, scores, cp_names, capacities, top_k=None, fill_unassigned=True) -> DataFrame
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+from scripts.instrument import instrumented
+from scripts.strength_index import build_strength_index, candidate_scores
+
+
+# Entries of the capacity-expanded matching graph; the matching peaks at about 40 bytes per entry (~2 GB)
+MAX_SLOT_EDGES = 50_000_000
+
+
+def strength_score_matrix(df_candidates: pd.DataFrame, strengths: pd.DataFrame, cp_names=None, p_threshold=0.05):
+    """Sum of significant effect sizes per (candidate, CP) from run_mannwhitney_tests output.
+
+    A candidate gets a CP's effect_size for every (Feature, Category) where the
+    CP is strong (p_value < p_threshold) and the candidate has that category.
+    Compiles the rows with strength_index.build_strength_index and scores with
+    candidate_scores, so both share one category matching.
+    """
+    index = build_strength_index(strengths, p_threshold=p_threshold, cp_names=cp_names)
+    return candidate_scores(index, df_candidates).astype(float), index['cp_names']
+
+
+@instrumented()
+def bid_probability_matrix(models, X_candidates: pd.DataFrame, cp_codes, cp_column='担当CP'):
+    """Predicted BID probability of every candidate under every CP.
+
+    X_candidates must be model-ready (see prepare_lgb_data) and contain cp_column
+    as a feature; cp_codes are that column's encoded values, one per CP. The
+    probabilities of all fold models are averaged.
+    """
+    if not isinstance(models, (list, tuple)):
+        models = [models]
+
+    X = X_candidates.copy()
+    probabilities = np.empty((len(X), len(cp_codes)))
+    for j, code in enumerate(cp_codes):
+        X[cp_column] = pd.Series(code, index=X.index, dtype=X_candidates[cp_column].dtype)
+        probabilities[:, j] = np.mean([_predict_proba(m, X) for m in models], axis=0)
+    return probabilities
+
+
+def _predict_proba(model, X):
+    if hasattr(model, 'predict_proba'):
+        return model.predict_proba(X)[:, 1]
+    return model.predict(X, num_iteration=model.best_iteration or None)
+
+
+def _candidate_edges(scores, top_k):
+    """Positive-score (candidate, CP, score) edges, optionally only each candidate's top_k CPs."""
+    if sparse.issparse(scores):
+        coo = scores.tocoo()
+        cand, cp, value = coo.row, coo.col, coo.data
+    else:
+        scores = np.asarray(scores, dtype=float)
+        if top_k is not None and top_k < scores.shape[1]:
+            cp = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            cand = np.repeat(np.arange(scores.shape[0]), top_k)
+            cp = cp.ravel()
+            value = scores[cand, cp]
+            top_k = None
+        else:
+            cand, cp = np.nonzero(scores > 0)
+            value = scores[cand, cp]
+
+    positive = value > 0
+    cand, cp, value = cand[positive], cp[positive], value[positive]
+    if top_k is not None:
+        # Sparse input: keep the top_k edges per candidate
+        order = np.lexsort((-value, cand))
+        cand, cp, value = cand[order], cp[order], value[order]
+        rank = np.arange(len(cand)) - np.searchsorted(cand, cand)
+        keep = rank < top_k
+        cand, cp, value = cand[keep], cp[keep], value[keep]
+    return cand, cp, value
+
+
+def _match_slots(cand, cp, value, capacities, n_cps):
+    """Maximum-score matching of candidates to CP capacity slots over the given edges.
+
+    Rows are the candidates with an edge, columns are the slots of every CP (a
+    CP never needs more slots than it has edges) followed by one "unassigned"
+    column per row, so a full matching of the rows always exists. An edge is
+    linked to every slot of its CP with weight score + 1 and the unassigned
+    column with weight 1; every row is matched exactly once, so the shift
+    does not change the optimum.
+    Returns (candidates, matched slot per candidate, CP of each slot).
+    """
+    order = np.argsort(cand, kind='stable')
+    cand, cp, value = cand[order], cp[order], value[order]
+    rows, row_of_edge = np.unique(cand, return_inverse=True)
+    slots = np.maximum(np.minimum(np.floor(capacities).astype(int), np.bincount(cp, minlength=n_cps)), 0)
+    slot_start = np.cumsum(slots) - slots
+    n_slots = int(slots.sum())
+
+    per_edge = slots[cp]
+    n_entries = int(per_edge.sum()) + len(rows)
+    if n_entries > MAX_SLOT_EDGES:
+        raise ValueError(f'the capacity-expanded graph has {n_entries} entries (limit MAX_SLOT_EDGES='
+                         f'{MAX_SLOT_EDGES}); pass top_k to keep fewer CPs per candidate')
+
+    # CSR laid out row by row: the slots of each of the row's edges, then its unassigned column
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(row_of_edge, weights=per_edge, minlength=len(rows))
+                                            .astype(np.int64) + 1)])
+    is_edge = np.ones(n_entries, dtype=bool)
+    is_edge[indptr[1:] - 1] = False
+    # The k-th entry of an edge is slot k of its CP: its position in the edge entries, shifted per edge
+    edge_cols = np.repeat(slot_start[cp] - (np.cumsum(per_edge) - per_edge), per_edge)
+    edge_cols += np.arange(len(edge_cols))
+    indices = np.empty(n_entries, dtype=np.int32 if n_slots + len(rows) < 2 ** 31 else np.int64)
+    indices[is_edge] = edge_cols
+    indices[~is_edge] = n_slots + np.arange(len(rows))
+    del edge_cols
+    data = np.ones(n_entries)
+    data[is_edge] = np.repeat(value + 1, per_edge)
+
+    graph = sparse.csr_matrix((data, indices, indptr), shape=(len(rows), n_slots + len(rows)))
+    row_ids, col_ids = min_weight_full_bipartite_matching(graph, maximize=True)
+    matched = col_ids < n_slots
+    return rows[row_ids[matched]], col_ids[matched], np.repeat(np.arange(n_cps), slots)
+
+
+@instrumented()
+def assign_candidates(scores, capacities, top_k=None, fill_unassigned=True):
+    """Assign each candidate to at most one CP, maximizing total score under CP capacities.
+
+    scores: (candidates x CPs) dense array or scipy sparse matrix; only
+        positive entries are considered as edges.
+    capacities: per-CP capacity, aligned with the score columns.
+    top_k: keep only each candidate's top_k CPs as edges (fewer slots to expand).
+    fill_unassigned: candidates without a positive edge go to the CPs with the
+        most remaining capacity.
+
+    Returns an int array with the CP column per candidate (-1 = unassigned).
+    """
+    n_candidates, n_cps = scores.shape
+    capacities = np.asarray(capacities, dtype=float)
+    assignment = np.full(n_candidates, -1)
+
+    cand, cp, value = _candidate_edges(scores, top_k)
+    if len(cand):
+        rows, slot_ids, slot_cp = _match_slots(cand, cp, value, capacities, n_cps)
+        assignment[rows] = slot_cp[slot_ids]
+
+    if fill_unassigned:
+        remaining = capacities - np.bincount(assignment[assignment >= 0], minlength=n_cps)
+        remaining = np.maximum(remaining, 0).astype(int)
+        # One slot per free place, interleaved round-robin across CPs (fullest free capacity first)
+        order = np.argsort(-remaining, kind='stable')
+        counts = remaining[order]
+        slot_cp = np.repeat(order, counts)
+        slot_rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        slot_cp = slot_cp[np.argsort(slot_rank, kind='stable')]
+
+        unassigned = np.flatnonzero(assignment < 0)
+        n_fill = min(len(unassigned), len(slot_cp))
+        assignment[unassigned[:n_fill]] = slot_cp[:n_fill]
+
+    return assignment
+
+
+def distribute_candidates(df_candidates: pd.DataFrame, scores, cp_names, capacities, top_k=None,
+                          fill_unassigned=True) -> pd.DataFrame:
+    """Assign a batch of candidates to CPs and return 求職者ID, 担当CP and the edge score.
+
+    capacities: dict {CP: capacity} (missing CPs get 0) or a sequence aligned with cp_names.
+    """
+    if isinstance(capacities, dict):
+        capacities = [capacities.get(cp, 0) for cp in cp_names]
+    assignment = assign_candidates(scores, capacities, top_k=top_k, fill_unassigned=fill_unassigned)
+
+    assigned = assignment >= 0
+    if sparse.issparse(scores):
+        score = np.zeros(len(assignment))
+        score[assigned] = np.asarray(scores.tocsr()[np.flatnonzero(assigned), assignment[assigned]]).ravel()
+    else:
+        score = np.where(assigned, np.asarray(scores)[np.arange(len(assignment)), np.maximum(assignment, 0)], 0.0)
+
+    cp_names = np.asarray(cp_names, dtype=object)
+    return pd.DataFrame({
+        '求職者ID': df_candidates['求職者ID'].to_numpy() if '求職者ID' in df_candidates.columns else df_candidates.index,
+        '担当CP': np.where(assigned, cp_names[np.maximum(assignment, 0)], None),
+        'score': score,
+    })
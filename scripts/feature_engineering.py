@@ -1,36 +1,129 @@
 """Feature engineering utilities extracted from the notebook.
 
 Functions:
-- create_features(df): returns df with new engineered columns
+- add_row_features(df, vectorized=False): returns df with the row-level (per 応募) features
+- create_features(df, vectorized=False, compact=False): returns df with new engineered columns
 """
 
 import pandas as pd
 import numpy as np
 
+from scripts.instrument import instrumented
+from scripts.utils import compact_dtypes, memory_usage_mb, report_memory
 
-def create_features(df: pd.DataFrame) -> pd.DataFrame:
-    """Add features used later in modeling and testing.
 
-    Implements:
-    - 転職経験
-    - ランクギャップ
-    - 登録経路（大）
-    - 年収ギャップ＋/ー
-    - エントリー数, エントリー業種一致率, エントリー職種一致率
-    - 平均年収ギャップ＋/ー, メイン紹介経路
-    - drop some interim columns if present
+RANK_MAPPING = {'S': 5, 'A': 4, 'B': 3, 'C': 2, 'D': 1}
+
+# Intermediate columns dropped at the end to mimic the original notebook
+INTERIM_COLUMNS = ['案件ランク', '求人ID', '企業', '年収ギャップ＋', '年収ギャップー', '業種一致', '職種一致']
+
+
+def _categorize_job_change(counts: pd.Series) -> pd.Series:
+    """Vectorized 転職経験: same values as the row-wise apply."""
+    result = counts.astype(object)
+    result = result.mask(counts >= 1, '転職1回以上')
+    result = result.mask(counts == 0, '転職なし')
+    return result.infer_objects()
+
+
+def _categorize_registration_route_vectorized(routes: pd.Series) -> pd.Series:
+    """Vectorized 登録経路（大）: first matching marker wins, missing -> '他'."""
+    route_str = routes.astype(str)
+    conditions = [
+        routes.notna() & route_str.str.contains('（スカウト）', regex=False),
+        routes.notna() & route_str.str.contains('（新規会員）', regex=False),
+        routes.notna() & route_str.str.contains('（案件応募）', regex=False),
+    ]
+    labels = np.select(conditions, ['スカウト', '新規', '案件'], default='他')
+    return pd.Series(labels, index=routes.index).infer_objects()
+
+
+def _match_flags_vectorized(values: pd.Series, experienced: pd.Series) -> np.ndarray:
+    """1 where `values` is one of the comma-separated entries in `experienced`.
+
+    Splits and explodes the comma-separated strings once and compares every
+    element against the row's value, instead of splitting row by row.
+    """
+    flags = np.zeros(len(values), dtype=int)
+    valid = np.flatnonzero((values.notna() & experienced.notna()).to_numpy())
+    if len(valid) == 0:
+        return flags
+
+    exploded = pd.Series(experienced.to_numpy()[valid]).astype(str).str.split(',').explode()
+    owner = exploded.index.to_numpy()
+    hits = exploded.str.strip().to_numpy(dtype=object) == values.to_numpy(dtype=object)[valid][owner]
+    flags[valid[np.unique(owner[hits])]] = 1
+    return flags
+
+
+def _mode_by_group(keys: pd.Series, values: pd.Series) -> pd.Series:
+    """Most frequent non-null value per key (ties -> smallest value, like Series.mode()[0])."""
+    counts = (pd.DataFrame({'key': keys.to_numpy(), 'value': values.to_numpy()})
+              .groupby(['key', 'value'], observed=True).size().reset_index(name='count'))
+    # groupby output is sorted by value within each key, so a stable sort keeps the smallest tied value first
+    counts = counts.sort_values(['key', 'count'], ascending=[True, False], kind='stable')
+    counts = counts.drop_duplicates(subset='key', keep='first')
+    return pd.Series(counts['value'].to_numpy(), index=counts['key'].to_numpy())
+
+
+def _aggregate_per_candidate(df: pd.DataFrame) -> pd.DataFrame:
+    """Compute every per-求職者ID feature in one grouped pass.
+
+    Returns one row per 求職者ID with エントリー数, エントリー業種一致率,
+    エントリー職種一致率, 平均年収ギャップ＋/ー and メイン紹介経路 (when the source
+    columns exist), ready to be merged back once.
     """
-    df = df.copy()
+    named_aggs = {'エントリー数': ('求職者ID', 'size')}
+    if '業種一致' in df.columns:
+        named_aggs['業種一致の合計'] = ('業種一致', 'sum')
+    if '職種一致' in df.columns:
+        named_aggs['職種一致の合計'] = ('職種一致', 'sum')
+    if '年収ギャップ＋' in df.columns:
+        named_aggs['平均年収ギャップ＋'] = ('年収ギャップ＋', 'mean')
+    if '年収ギャップー' in df.columns:
+        named_aggs['平均年収ギャップー'] = ('年収ギャップー', 'mean')
+
+    agg = df.groupby('求職者ID').agg(**named_aggs)
+
+    # Without 業種一致 the original notebook divided size by size, i.e. a rate of 1
+    industry_matches = agg['業種一致の合計'] if '業種一致の合計' in agg.columns else agg['エントリー数']
+    agg.insert(1, 'エントリー業種一致率', (industry_matches / agg['エントリー数']).fillna(0))
+    if '職種一致の合計' in agg.columns:
+        agg.insert(2, 'エントリー職種一致率', (agg['職種一致の合計'] / agg['エントリー数']).fillna(0))
+    agg = agg.drop(columns=[c for c in ['業種一致の合計', '職種一致の合計'] if c in agg.columns])
+
+    if '紹介経路' in df.columns:
+        agg['メイン紹介経路'] = _mode_by_group(df['求職者ID'], df['紹介経路'])
+
+    return agg.reset_index()
+
+
+def _map_ranks(ranks: pd.Series, rank_mapping: dict) -> pd.Series:
+    # Series.map on a category column returns a category column, which cannot be subtracted
+    if isinstance(ranks.dtype, pd.CategoricalDtype):
+        ranks = ranks.astype(object)
+    return ranks.map(rank_mapping)
+
+
+@instrumented()
+def add_row_features(df: pd.DataFrame, vectorized: bool = False) -> pd.DataFrame:
+    """Add the features computed from a single 応募 row.
+
+    Implements 転職経験, ランクギャップ, 登録経路（大）, 年収ギャップ＋/ー and the
+    業種一致 / 職種一致 flags that the per-求職者ID aggregation sums up.
+    """
+    df = df.copy(deep=False)
 
     # 転職経験
-    if '転職回数' in df.columns:
+    if '転職回数' in df.columns and vectorized:
+        df['転職経験'] = _categorize_job_change(df['転職回数'])
+    elif '転職回数' in df.columns:
         df['転職経験'] = df['転職回数'].apply(lambda x: '転職なし' if x == 0 else ('転職1回以上' if x >= 1 else x))
 
     # ランクギャップ
-    rank_mapping = {'S': 5, 'A': 4, 'B': 3, 'C': 2, 'D': 1}
     if '人材ランク_x' in df.columns and '案件ランク' in df.columns:
-        df['人材ランク_numeric'] = df['人材ランク_x'].map(rank_mapping)
-        df['案件ランク_numeric'] = df['案件ランク'].map(rank_mapping)
+        df['人材ランク_numeric'] = _map_ranks(df['人材ランク_x'], RANK_MAPPING)
+        df['案件ランク_numeric'] = _map_ranks(df['案件ランク'], RANK_MAPPING)
         df['ランクギャップ'] = df['案件ランク_numeric'] - df['人材ランク_numeric']
         df = df.drop(columns=[c for c in ['人材ランク_numeric', '案件ランク_numeric'] if c in df.columns])
 
@@ -48,7 +141,9 @@ def create_features(df: pd.DataFrame) -> pd.DataFrame:
         else:
             return '他'
 
-    if '登録経路' in df.columns:
+    if '登録経路' in df.columns and vectorized:
+        df['登録経路（大）'] = _categorize_registration_route_vectorized(df['登録経路'])
+    elif '登録経路' in df.columns:
         df['登録経路（大）'] = df['登録経路'].apply(categorize_registration_route)
 
     # 年収ギャップ
@@ -65,42 +160,48 @@ def create_features(df: pd.DataFrame) -> pd.DataFrame:
         experienced_industries = [s.strip() for s in str(experienced_industries_str).split(',')]
         return 1 if job_industry in experienced_industries else 0
 
-    if '業種' in df.columns and '経験業種' in df.columns:
+    if '業種' in df.columns and '経験業種' in df.columns and vectorized:
+        df['業種一致'] = _match_flags_vectorized(df['業種'], df['経験業種'])
+    elif '業種' in df.columns and '経験業種' in df.columns:
         df['業種一致'] = df.apply(lambda row: check_industry_match(row['業種'], row['経験業種']), axis=1).astype(int)
 
-    if '職種' in df.columns and 'コア経験職種_x' in df.columns:
+    if '職種' in df.columns and 'コア経験職種_x' in df.columns and vectorized:
+        df['職種一致'] = _match_flags_vectorized(df['職種'], df['コア経験職種_x'])
+    elif '職種' in df.columns and 'コア経験職種_x' in df.columns:
         df['職種一致'] = df.apply(lambda row: check_industry_match(row['職種'], row['コア経験職種_x']), axis=1).astype(int)
 
-    if '求職者ID' in df.columns:
-        agg = df.groupby('求職者ID').agg(
-            エントリー数=('求職者ID', 'size'),
-            業種一致の合計=('業種一致', 'sum') if '業種一致' in df.columns else pd.NamedAgg(column='求職者ID', aggfunc='size')
-        ).reset_index()
+    return df
 
-        agg['エントリー業種一致率'] = (agg['業種一致の合計'] / agg['エントリー数']).fillna(0)
-        df = pd.merge(df, agg[['求職者ID', 'エントリー数', 'エントリー業種一致率']], on='求職者ID', how='left')
 
-        # 職種一致率
-        if '職種一致' in df.columns:
-            agg_job = df.groupby('求職者ID').agg(職種一致の合計=('職種一致', 'sum')).reset_index()
-            agg_job['エントリー職種一致率'] = (agg_job['職種一致の合計'] / agg['エントリー数']).fillna(0)
-            df = pd.merge(df, agg_job[['求職者ID', 'エントリー職種一致率']], on='求職者ID', how='left')
+@instrumented()
+def create_features(df: pd.DataFrame, vectorized: bool = False, compact: bool = False) -> pd.DataFrame:
+    """Add features used later in modeling and testing.
 
-    # 平均年収ギャップ per 求職者ID
-    if '年収ギャップ＋' in df.columns:
-        avg_gap_plus = df.groupby('求職者ID')['年収ギャップ＋'].mean().reset_index().rename(columns={'年収ギャップ＋': '平均年収ギャップ＋'})
-        df = pd.merge(df, avg_gap_plus, on='求職者ID', how='left')
-    if '年収ギャップー' in df.columns:
-        avg_gap_minus = df.groupby('求職者ID')['年収ギャップー'].mean().reset_index().rename(columns={'年収ギャップー': '平均年収ギャップー'})
-        df = pd.merge(df, avg_gap_minus, on='求職者ID', how='left')
+    Implements:
+    - 転職経験
+    - ランクギャップ
+    - 登録経路（大）
+    - 年収ギャップ＋/ー
+    - エントリー数, エントリー業種一致率, エントリー職種一致率
+    - 平均年収ギャップ＋/ー, メイン紹介経路 (one grouped pass, merged back once)
+    - drop some interim columns if present
 
-    # メイン紹介経路 (mode)
-    if '紹介経路' in df.columns:
-        mode_route = df.groupby('求職者ID')['紹介経路'].apply(lambda x: x.mode()[0] if not x.mode().empty else None).reset_index().rename(columns={'紹介経路': 'メイン紹介経路'})
-        df = pd.merge(df, mode_route, on='求職者ID', how='left')
+    vectorized=True computes 転職経験, 登録経路（大）, 業種一致 and 職種一致 with
+    string-accessor / exploded set-membership operations instead of per-row
+    applies. Results are identical to the default path.
+    compact=True works on a shallow copy and compacts the new columns.
+    """
+    df = add_row_features(df.copy(deep=not compact), vectorized=vectorized)
+
+    if '求職者ID' in df.columns:
+        df = pd.merge(df, _aggregate_per_candidate(df), on='求職者ID', how='left')
 
     # Drop intermediate columns if present to mimic original notebook
-    drop_cols = ['案件ランク', '求人ID', '企業', '年収ギャップ＋', '年収ギャップー', '業種一致', '職種一致']
-    df = df.drop(columns=[c for c in drop_cols if c in df.columns])
+    df = df.drop(columns=[c for c in INTERIM_COLUMNS if c in df.columns])
+
+    if compact:
+        before_mb = memory_usage_mb(df)
+        df = compact_dtypes(df)
+        report_memory('create_features', before_mb, memory_usage_mb(df))
 
     return df
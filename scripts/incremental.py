@@ -0,0 +1,260 @@
+"""Incremental daily refresh of the per-candidate dataset.
+
+Instead of rebuilding df_final from the complete 面談/応募/成約 sheets, the
+per-求職者ID aggregate state is kept on disk and only the new 応募 rows are
+applied to it.
+
+State (indexed by 求職者ID):
+- sums: エントリー数 and the sums of 業種一致 / 職種一致 / 年収ギャップ＋ / 年収ギャップー
+- route_counts: one column per 紹介経路 value with the number of entries
+- candidates: the first row of each candidate plus the derived per-candidate features
+
+On disk every table (plus 'final', the finalized rows without BID) is a
+directory of part-NNNNN.parquet files. A refresh appends one part per table
+holding only the rows of the candidates its delta touched, and re-finalizes
+only those candidates; the newest part wins when a candidate appears in
+several. compact_state rewrites each table as a single part.
+
+Functions:
+- empty_state() -> state dict
+- update_state(state, df_rows) -> (state, changed_ids)
+- state_to_dataset(state, df_seiyaku) -> df_final
+- save_state(state, state_dir, changed_ids=None) / load_state(state_dir, ids=None)
+- load_dataset(state_dir, df_seiyaku) -> df_final
+- compact_state(state_dir)
+- refresh_dataset(state_dir, df_mendan, df_oubo_delta, df_seiyaku) -> df_final
+"""
+
+import glob
+import os
+
+import pandas as pd
+
+from scripts.feature_engineering import INTERIM_COLUMNS, add_row_features
+from scripts.instrument import instrumented
+from scripts.preprocessing import add_time_deltas, finalize_dataset, merge_bid, preprocess_merge
+
+
+SUM_COLUMNS = ['業種一致', '職種一致', '年収ギャップ＋', '年収ギャップー']
+STATE_TABLES = ['sums', 'route_counts', 'candidates']
+
+
+def empty_state():
+    """State with no candidates; the first update_state call builds it from the full history."""
+    return {name: pd.DataFrame(index=pd.Index([], name='求職者ID')) for name in STATE_TABLES}
+
+
+def _add_counts(current: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+    """Add delta onto current (both indexed by 求職者ID), touching only the delta's IDs."""
+    for col in delta.columns:
+        if col not in current.columns:
+            current[col] = 0
+    delta = delta.reindex(columns=current.columns, fill_value=0)
+
+    existing = delta.index.intersection(current.index)
+    if len(existing):
+        current.loc[existing] = current.loc[existing].to_numpy() + delta.loc[existing].to_numpy()
+    new = delta.index.difference(current.index)
+    if len(new):
+        current = pd.concat([current, delta.loc[new]]) if len(current) else delta.loc[new].copy()
+    return current
+
+
+def _derive_features(sums: pd.DataFrame, route_counts: pd.DataFrame) -> pd.DataFrame:
+    """Per-candidate features from the aggregate state (same formulas as create_features)."""
+    entries = sums['エントリー数']
+    derived = pd.DataFrame({'エントリー数': entries.astype(int)}, index=sums.index)
+    industry_matches = sums['業種一致'] if '業種一致' in sums.columns else entries
+    derived['エントリー業種一致率'] = (industry_matches / entries).fillna(0)
+    if '職種一致' in sums.columns:
+        derived['エントリー職種一致率'] = (sums['職種一致'] / entries).fillna(0)
+    if '年収ギャップ＋' in sums.columns:
+        derived['平均年収ギャップ＋'] = sums['年収ギャップ＋'] / entries
+    if '年収ギャップー' in sums.columns:
+        derived['平均年収ギャップー'] = sums['年収ギャップー'] / entries
+
+    if len(route_counts.columns):
+        # Columns are sorted, so idxmax's first maximum is the smallest tied value (as Series.mode()[0])
+        counts = route_counts.loc[sums.index, sorted(route_counts.columns)]
+        mode_route = counts.idxmax(axis=1)
+        derived['メイン紹介経路'] = mode_route.where(counts.max(axis=1) > 0)
+    return derived
+
+
+@instrumented()
+def update_state(state, df_rows: pd.DataFrame):
+    """Apply new 応募 rows (output of add_row_features) to the state.
+
+    Only the 求職者ID values present in df_rows are touched. Returns the
+    updated state and the changed IDs.
+    """
+    df_rows = df_rows[df_rows['求職者ID'].notna()]
+    changed_ids = pd.Index(df_rows['求職者ID'].unique(), name='求職者ID')
+    if len(changed_ids) == 0:
+        return state, changed_ids
+
+    named_aggs = {'エントリー数': ('求職者ID', 'size')}
+    named_aggs.update({col: (col, 'sum') for col in SUM_COLUMNS if col in df_rows.columns})
+    delta_sums = df_rows.groupby('求職者ID').agg(**named_aggs)
+    sums = _add_counts(state['sums'], delta_sums)
+
+    route_counts = state['route_counts']
+    if '紹介経路' in df_rows.columns:
+        delta_routes = df_rows.groupby(['求職者ID', '紹介経路'], observed=True).size().unstack(fill_value=0)
+        delta_routes.columns = delta_routes.columns.astype(str)
+        delta_routes = delta_routes.reindex(changed_ids, fill_value=0)
+        route_counts = _add_counts(route_counts, delta_routes)
+
+    candidates = state['candidates']
+    # Keep 求職者ID as a column too, so df_final keeps the original column order
+    first_rows = df_rows.drop_duplicates(subset=['求職者ID'], keep='first')
+    first_rows = first_rows.drop(columns=[c for c in INTERIM_COLUMNS if c in first_rows.columns])
+    first_rows.index = pd.Index(first_rows['求職者ID'].to_numpy())
+    new_ids = first_rows.index.difference(candidates.index, sort=False)
+    derived = _derive_features(sums.loc[changed_ids], route_counts)
+    if len(new_ids):
+        new_candidates = first_rows.loc[new_ids].join(derived.loc[new_ids])
+        candidates = pd.concat([candidates, new_candidates]) if len(candidates) else new_candidates
+    existing = changed_ids.difference(new_ids)
+    if len(existing):
+        candidates.loc[existing, derived.columns] = derived.loc[existing]
+
+    return {'sums': sums, 'route_counts': route_counts, 'candidates': candidates}, changed_ids
+
+
+def state_to_dataset(state, df_seiyaku: pd.DataFrame) -> pd.DataFrame:
+    """Apply the finalize_dataset filters and BID flags to the candidate table."""
+    candidates = state['candidates'].reset_index(drop=True)
+    return finalize_dataset(candidates, None, None, df_seiyaku)
+
+
+def _parts(state_dir: str, name: str):
+    return sorted(glob.glob(os.path.join(state_dir, name, 'part-*.parquet')))
+
+
+def _append_part(state_dir: str, name: str, df: pd.DataFrame):
+    os.makedirs(os.path.join(state_dir, name), exist_ok=True)
+    df.to_parquet(os.path.join(state_dir, name, f'part-{len(_parts(state_dir, name)):05d}.parquet'))
+
+
+def _read_parts(state_dir: str, name: str, ids=None) -> pd.DataFrame:
+    """Concatenate a table's parts (only the rows of ids when given); the newest row of each 求職者ID wins.
+
+    Rows keep the position of their candidate's first appearance, as in a
+    table that was updated in place.
+    """
+    filters = None if ids is None else [('求職者ID', 'in', list(ids))]
+    frames = [pd.read_parquet(path, filters=filters) for path in _parts(state_dir, name)]
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return None
+    # Parts can have different columns (e.g. a new 紹介経路)
+    df = pd.concat(frames) if len(frames) > 1 else frames[0]
+    key = pd.Index(df['求職者ID']) if name == 'final' else df.index
+    latest = df[~key.duplicated(keep='last')]
+    latest_key = key[~key.duplicated(keep='last')]
+    order = pd.Index(key.unique())
+    return _restore_datetime_units(latest.iloc[latest_key.get_indexer(order)], _parts(state_dir, name)[-1])
+
+
+def _restore_datetime_units(df: pd.DataFrame, path: str) -> pd.DataFrame:
+    """Cast datetime columns back to the unit they were written with (parquet has no datetime64[s])."""
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(path).pandas_metadata or {}
+    for column in metadata.get('columns', []):
+        name, numpy_type = column['name'], column['numpy_type']
+        if (name in df.columns and numpy_type.startswith('datetime64[')
+                and df[name].dtype.kind == 'M' and str(df[name].dtype) != numpy_type):
+            df[name] = df[name].astype(numpy_type)
+    return df
+
+
+def save_state(state, state_dir: str, changed_ids=None):
+    """Append the rows of changed_ids to each table; changed_ids=None writes the whole state as the only part."""
+    for name in STATE_TABLES:
+        table = state[name]
+        if changed_ids is None:
+            for path in _parts(state_dir, name):
+                os.remove(path)
+        else:
+            table = table.loc[table.index.intersection(changed_ids)]
+        _append_part(state_dir, name, table)
+
+
+def load_state(state_dir: str, ids=None):
+    """Load a saved state (only the candidates in ids when given), or an empty state when state_dir has none yet."""
+    state = empty_state()
+    for name in STATE_TABLES:
+        table = _read_parts(state_dir, name, ids)
+        if table is not None:
+            state[name] = table
+    if len(state['route_counts'].columns):
+        # Older parts lack the 紹介経路 values that appeared later
+        state['route_counts'] = state['route_counts'].fillna(0).astype('int64')
+    return state
+
+
+def _save_final_rows(state, state_dir: str, changed_ids):
+    """Append the rows of changed_ids (without BID), with _removed set on the IDs the filters drop.
+
+    Filtered-out IDs keep their own candidate row as the marker rather than a
+    NaN-filled one, so the part keeps the candidate table's dtypes.
+    """
+    candidates = state['candidates']
+    # Candidate-table order, so a candidate that only passes the filters later keeps its position
+    ids = candidates.index.intersection(changed_ids)
+    rows = candidates.loc[ids].reset_index(drop=True)
+    final = finalize_dataset(rows, None, None, pd.DataFrame())
+    rows = rows.drop_duplicates(subset=['求職者ID'], keep='first')
+    _append_part(state_dir, 'final', rows.assign(_removed=~rows['求職者ID'].isin(final['求職者ID'])))
+
+
+def load_dataset(state_dir: str, df_seiyaku: pd.DataFrame) -> pd.DataFrame:
+    """df_final from the saved finalized rows; BID is merged here so 成約 updates apply to every candidate."""
+    final = _read_parts(state_dir, 'final')
+    if final is None:
+        return pd.DataFrame()
+    final = final[~final['_removed'].astype(bool)].drop(columns='_removed').reset_index(drop=True)
+    return merge_bid(final, df_seiyaku)
+
+
+def compact_state(state_dir: str):
+    """Rewrite every table as a single part (the newest row per candidate)."""
+    for name in STATE_TABLES + ['final']:
+        table = _read_parts(state_dir, name)
+        if table is None:
+            continue
+        if name == 'final':
+            table = table[~table['_removed'].astype(bool)].reset_index(drop=True)
+        elif name == 'route_counts' and len(table.columns):
+            table = table.fillna(0).astype('int64')
+        for path in _parts(state_dir, name):
+            os.remove(path)
+        _append_part(state_dir, name, table)
+
+
+@instrumented()
+def refresh_dataset(state_dir: str, df_mendan: pd.DataFrame, df_oubo_delta: pd.DataFrame, df_seiyaku: pd.DataFrame,
+                    vectorized: bool = True) -> pd.DataFrame:
+    """Apply only the new 応募 rows to the saved state and return the refreshed df_final.
+
+    On the first run (no state in state_dir) pass the full 応募 history as
+    df_oubo_delta; later runs only need the rows added since the last refresh.
+    The candidate table keeps each candidate's first 応募 row, so deltas must
+    be appended in the same order as the original sheet.
+    Only the state rows of the candidates in the delta are loaded, updated,
+    re-finalized and appended to state_dir; reading back df_final is the only
+    step that touches every candidate.
+    """
+    df_rows = preprocess_merge(df_mendan, df_oubo_delta)
+    df_rows = add_time_deltas(df_rows, df_mendan, df_oubo_delta, vectorized=vectorized)
+    df_rows = add_row_features(df_rows, vectorized=vectorized)
+
+    delta_ids = pd.Index(df_rows['求職者ID'].dropna().unique())
+    state = load_state(state_dir, ids=delta_ids)
+    state, changed_ids = update_state(state, df_rows)
+    if len(changed_ids):
+        save_state(state, state_dir, changed_ids)
+        _save_final_rows(state, state_dir, changed_ids)
+    return load_dataset(state_dir, df_seiyaku)
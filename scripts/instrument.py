@@ -0,0 +1,256 @@
+"""Opt-in profiling of the pipeline stages.
+
+The stage functions in scripts/ are wrapped with @instrumented and the
+per-CP / per-fold loops open span() blocks. By default the active recorder
+is a no-op, so the only cost is one attribute check per call. Activating a
+recorder emits one structured event per stage / span with wall time, CPU
+time, peak memory and input/output row and column counts.
+
+Functions / classes:
+- JsonLinesRecorder(path, trace_memory=False): appends one JSON object per event to a file
+- InMemoryRecorder(trace_memory=False): keeps events in a list (to_frame() for a DataFrame)
+- set_recorder(recorder) / get_recorder()
+- recording(recorder): context manager that activates a recorder temporarily
+- instrumented(name=None): decorator for stage functions
+- span(name, **fields): context manager for sub-steps (e.g. cp=..., fold=...)
+- iter_spans(name, items, fields=None): yields items, each inside its own span (for loops)
+
+Event fields: event, name, parent, start (ISO time), wall_s, cpu_s (process
+CPU time, so it includes LightGBM's threads), peak_mb (only with
+trace_memory=True: peak traced allocations above the span's start, measured
+with tracemalloc; None for spans in worker threads, whose allocations count
+towards the enclosing main-thread span), rows_in, cols_in, rows_out, cols_out, plus the span fields.
+Work done in process-pool workers is not recorded.
+"""
+
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+
+class Recorder:
+    """No-op recorder (the default)."""
+
+    enabled = False
+    trace_memory = False
+
+    def emit(self, event: dict):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonLinesRecorder(Recorder):
+    """Append events as JSON lines to path (one object per line)."""
+
+    enabled = True
+
+    def __init__(self, path: str, trace_memory: bool = False):
+        self.path = path
+        self.trace_memory = trace_memory
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def emit(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class InMemoryRecorder(Recorder):
+    """Keep events in self.events, e.g. for a notebook session."""
+
+    enabled = True
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.events = []
+
+    def emit(self, event: dict):
+        self.events.append(event)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.events)
+
+
+_NULL_RECORDER = Recorder()
+_recorder = _NULL_RECORDER
+_local = threading.local()
+
+
+def get_recorder() -> Recorder:
+    return _recorder
+
+
+def set_recorder(recorder):
+    """Activate recorder (None restores the no-op default); returns the previous one."""
+    global _recorder
+    previous = _recorder
+    _recorder = _NULL_RECORDER if recorder is None else recorder
+    if _recorder.trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return previous
+
+
+@contextmanager
+def recording(recorder):
+    """Activate recorder for the with block, then restore the previous one and close it."""
+    previous = set_recorder(recorder)
+    started_tracing = recorder.trace_memory and previous is _NULL_RECORDER
+    try:
+        yield recorder
+    finally:
+        set_recorder(previous)
+        if started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        recorder.close()
+
+
+def _shape(obj):
+    """(rows, cols) of a DataFrame, the summed rows of a list of DataFrames, or the first DataFrame of a tuple."""
+    if isinstance(obj, pd.DataFrame):
+        return obj.shape
+    if isinstance(obj, pd.Series):
+        return len(obj), 1
+    if isinstance(obj, list) and obj and all(isinstance(item, pd.DataFrame) for item in obj):
+        return sum(len(item) for item in obj), obj[0].shape[1]
+    if isinstance(obj, tuple):
+        for item in obj:
+            if isinstance(item, pd.DataFrame):
+                return item.shape
+    return None, None
+
+
+class _Span:
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+        self.output = None
+
+    def set_output(self, obj):
+        """Record the rows/cols of obj as rows_out / cols_out."""
+        self.output = obj
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.child_peak = 0
+        # tracemalloc's peak is process-wide: spans in worker threads (e.g. CV folds) would reset the
+        # peak of the span around the pool, so only main-thread spans measure memory
+        self.track_memory = (self.recorder.trace_memory and tracemalloc.is_tracing()
+                             and threading.current_thread() is threading.main_thread())
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(stack) > 1:
+                # Keep the parent's peak before resetting it for this span
+                stack[-2].child_peak = max(stack[-2].child_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = current
+        self.start = datetime.now()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall_s = time.perf_counter() - self.wall_start
+        cpu_s = time.process_time() - self.cpu_start
+        peak_mb = None
+        stack = _local.__dict__.setdefault('stack', [])
+        if self in stack:
+            # Spans still above this one were abandoned without closing (e.g. a half-consumed
+            # iter_spans generator); drop them so they cannot become later spans' parent
+            del stack[stack.index(self):]
+        if self.track_memory and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            peak_mb = (peak - self.memory_start) / 1024 ** 2
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+
+        rows_out, cols_out = _shape(self.output)
+        event = {'event': 'span', 'name': self.name, 'parent': self.parent,
+                 'start': self.start.isoformat(timespec='milliseconds'),
+                 'wall_s': wall_s, 'cpu_s': cpu_s, 'peak_mb': peak_mb,
+                 'rows_out': rows_out, 'cols_out': cols_out}
+        if exc_type is not None:
+            event['error'] = exc_type.__name__
+        event.update(self.fields)
+        self.recorder.emit(event)
+        return False
+
+
+class _NullSpan:
+    def set_output(self, obj):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, **fields):
+    """Context manager timing a sub-step; fields (cp=..., fold=..., rows_in=...) are added to the event."""
+    recorder = _recorder
+    if not recorder.enabled:
+        return _NULL_SPAN
+    return _Span(recorder, name, fields)
+
+
+def iter_spans(name: str, items, fields=None):
+    """Yield items; each one's loop body runs inside span(name, **fields(item)).
+
+    The span stays open until the loop asks for the next item, so an existing
+    loop gets per-iteration spans by wrapping its iterable. A for loop over the
+    generator closes it when the loop ends, breaks or raises (CPython frees it
+    right away); code that keeps a reference to a half-consumed generator must
+    close it (e.g. contextlib.closing), or the open span is only recorded when
+    the generator is garbage-collected. With no active recorder the items are
+    passed through and fields is never called.
+    """
+    if not _recorder.enabled:
+        yield from items
+        return
+    for item in items:
+        with span(name, **(fields(item) if fields is not None else {})):
+            yield item
+
+
+def instrumented(name=None):
+    """Decorator emitting a 'stage' event per call, with rows/cols of the first DataFrame argument and the result."""
+    def decorator(fn):
+        stage = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if not recorder.enabled:
+                return fn(*args, **kwargs)
+
+            rows_in, cols_in = None, None
+            for arg in list(args) + list(kwargs.values()):
+                rows_in, cols_in = _shape(arg)
+                if rows_in is not None:
+                    break
+            with _Span(recorder, stage, {'event': 'stage', 'rows_in': rows_in, 'cols_in': cols_in}) as current:
+                result = fn(*args, **kwargs)
+                current.set_output(result)
+            return result
+        return wrapper
+    return decorator
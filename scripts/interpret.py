@@ -1,19 +1,29 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from scripts.instrument import instrumented
+from scripts.utils import frame_hash, model_booster, resolve_n_jobs
+
 
 def plot_feature_importance(models, X, top_n=15):
     """Plot average feature importances from trained LightGBM model(s).
 
-    models: single estimator or list of estimators (with attribute feature_importances_)
+    models: single estimator or list of estimators (LGBMClassifier or lgb.Booster)
     X: DataFrame used for feature names
     """
+    def feature_importances(m):
+        return m.feature_importances_ if hasattr(m, 'feature_importances_') else m.feature_importance()
+
     if isinstance(models, (list, tuple)):
-        importances = np.mean([m.feature_importances_ for m in models], axis=0)
+        importances = np.mean([feature_importances(m) for m in models], axis=0)
     else:
-        importances = models.feature_importances_
+        importances = feature_importances(models)
 
     importance_df = pd.DataFrame({'Feature': X.columns, 'Importance': importances})
     importance_df = importance_df.sort_values('Importance', ascending=False)
@@ -27,19 +37,122 @@ def plot_feature_importance(models, X, top_n=15):
     return importance_df
 
 
-def compute_shap_values(model, X_explain, nsamples=100):
+def stratified_sample(X, nsamples, stratify=None, random_state=42):
+    """Rows of X for a sample of nsamples, allocated proportionally to the strata.
+
+    stratify: a column name of X or an array-like aligned with X (e.g. Y);
+        None samples uniformly. Rows keep their original order.
+    """
+    n_rows = len(X)
+    if nsamples is None or nsamples >= n_rows:
+        return X
+    if stratify is None:
+        codes = np.zeros(n_rows, dtype=int)
+    else:
+        values = X[stratify] if isinstance(stratify, str) else stratify
+        codes = pd.factorize(pd.Series(np.asarray(values)), use_na_sentinel=False)[0]
+
+    # Shuffle within strata, then take every (n_rows / nsamples)-th row: each
+    # stratum gets its proportional share (systematic sampling)
+    rng = np.random.default_rng(random_state)
+    order = np.lexsort((rng.random(n_rows), codes))
+    picks = order[(np.arange(nsamples) * n_rows // nsamples)]
+    return X.iloc[np.sort(picks)]
+
+
+def _model_hash(models):
+    digest = hashlib.sha256()
+    for model in models:
+        digest.update(model_booster(model).model_to_string().encode())
+    return digest.hexdigest()
+
+
+def _positive_class(values):
+    # shap < 0.45 returns [negative, positive] for binary LightGBM models
+    if isinstance(values, (list, tuple)):
+        return np.asarray(values[-1])
+    values = np.asarray(values)
+    return values[..., -1] if values.ndim == 3 else values
+
+
+def _contributions(model, X_chunk, method):
+    """SHAP values (rows x features, log-odds) of one model for one chunk."""
+    if method == 'native':
+        booster = model_booster(model)
+        best_iteration = getattr(model, 'best_iteration_', None) or booster.best_iteration or None
+        # pred_contrib appends the expected value as a last column
+        return booster.predict(X_chunk, num_iteration=best_iteration, pred_contrib=True)[:, :-1]
+
+    import shap
+    return _positive_class(shap.TreeExplainer(model).shap_values(X_chunk))
+
+
+def _contributions_task(args):
+    start, model, X_chunk, method = args
+    return start, _contributions(model, X_chunk, method)
+
+
+@instrumented()
+def compute_shap_values(model, X_explain, nsamples=None, method='shap', stratify=None, random_state=42,
+                        chunk_size=10000, n_jobs=1, cache_dir=None):
     """Compute SHAP values for a model and dataset.
 
-    model: a trained LightGBM model (or first model from an ensemble)
+    model: a trained LightGBM model, or a list of fold models whose SHAP
+        values are averaged (the SHAP values of the averaged log-odds)
     X_explain: DataFrame to explain
+    nsamples: explain only stratified_sample(X_explain, nsamples, stratify,
+        random_state); pass the same sample to the plots
+    method: 'shap' (shap.TreeExplainer) or 'native' (LightGBM pred_contrib,
+        same values without the shap package)
+    chunk_size / n_jobs: rows per task and worker processes (-1 = all cores);
+        every (chunk, fold model) pair is one task
+    cache_dir: store the values under a key of the model and data hashes, so
+        repeated calls (e.g. before each plot) load them instead of recomputing
+
+    Returns (explainer, shap_values) with shap_values as a (rows x features)
+    array for the positive class. explainer is the first model's
+    TreeExplainer, or None for method='native'.
     """
-    try:
-        import shap
-    except Exception as e:
-        raise ImportError('shap is required for SHAP explanations: pip install shap') from e
+    models = list(model) if isinstance(model, (list, tuple)) else [model]
+    if method not in ('shap', 'native'):
+        raise ValueError("method must be 'shap' or 'native'")
+
+    explainer = None
+    if method == 'shap':
+        try:
+            import shap
+        except Exception as e:
+            raise ImportError('shap is required for SHAP explanations: pip install shap') from e
+        explainer = shap.TreeExplainer(models[0])
+
+    X_explain = stratified_sample(X_explain, nsamples, stratify, random_state)
+
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha256(f'{_model_hash(models)}:{frame_hash(X_explain)}:{method}'.encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, f'shap_{key[:32]}.npy')
+        if os.path.exists(cache_path):
+            return explainer, np.load(cache_path)
+
+    tasks = [(start, m, X_explain.iloc[start:start + chunk_size], method)
+             for m in models
+             for start in range(0, len(X_explain), chunk_size)]
+    shap_values = np.zeros((len(X_explain), X_explain.shape[1]))
+
+    n_workers = min(resolve_n_jobs(n_jobs), len(tasks))
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = executor.map(_contributions_task, tasks)
+            for start, values in results:
+                shap_values[start:start + len(values)] += values
+    else:
+        for start, values in map(_contributions_task, tasks):
+            shap_values[start:start + len(values)] += values
+    shap_values /= len(models)
 
-    explainer = shap.TreeExplainer(model)
-    shap_values = explainer.shap_values(X_explain)
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_path, shap_values)
     return explainer, shap_values
 
 
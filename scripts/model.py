@@ -1,56 +1,214 @@
 """LightGBM training utilities.
 
 Functions:
-- prepare_lgb_data(df, features, target='BID') -> X, Y, categorical_features, numerical_features
-- train_lgb_cv(X, Y, categorical_features, params=None, n_splits=4, manual_threshold=0.12)
+- prepare_lgb_data(df, features, target='BID', return_preprocessor=False) -> X, Y, categorical_features, numerical_features
+- fit_preprocessor(df, features) -> preprocessor dict (category labels, fill values, feature order)
+- transform_features(df, preprocessor) -> X encoded like prepare_lgb_data
+- train_lgb_cv(X, Y, categorical_features, params=None, n_splits=4, manual_threshold=0.12, fold_datasets=None,
+  n_jobs=1, threads_per_fold=None)
+- build_fold_datasets(X, Y, categorical_features, n_splits=4, random_state=42, dataset_params=None) -> list of folds
+- native_train_params(params) -> (dataset params, lgb.train params, num_boost_round)
+- train_fold_booster(fold, params, early_stopping_rounds=100) -> lgb.Booster
+- threshold_sweep(y_true, y_proba) -> DataFrame of precision/recall/F1 per threshold
 
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 import lightgbm as lgb
 from sklearn.model_selection import StratifiedKFold
-from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import roc_auc_score, f1_score
 
+from scripts.instrument import instrumented, span
+from scripts.utils import resolve_n_jobs
+
+
+def _is_categorical(series: pd.Series) -> bool:
+    # pandas >= 3 reads text columns as the 'str' dtype rather than object
+    return series.dtype == 'object' or isinstance(series.dtype, (pd.CategoricalDtype, pd.StringDtype))
+
+
+# Label of a missing categorical value (str(np.nan)), whether it arrives as NaN, None or pd.NA
+MISSING_LABEL = 'nan'
+
+
+def label_string(value) -> str:
+    """Category label of one value, as fit_preprocessor stores it."""
+    return MISSING_LABEL if value is None or pd.isna(value) else str(value)
 
-def prepare_lgb_data(df: pd.DataFrame, features: list, target: str = 'BID'):
-    df = df.copy()
-    X = df[features].copy()
-    Y = df[target].copy()
 
-    categorical_features = [col for col in features if X[col].dtype == 'object' or X[col].dtype.name == 'category']
-    numerical_features = [col for col in features if col not in categorical_features]
+def _as_label_strings(series: pd.Series) -> pd.Series:
+    """str() of every value, as LabelEncoder().fit_transform(series.astype(str)) saw it on object columns.
 
-    # Label encode categorical columns
-    for col in categorical_features:
-        le = LabelEncoder()
-        X[col] = le.fit_transform(X[col].astype(str))
-        X[col] = X[col].astype('category')
+    Every missing value becomes MISSING_LABEL, so None and NaN share one code.
+    """
+    labels = pd.Series(series.to_numpy(dtype=object), index=series.index).map(str)
+    return labels.mask(series.isna().to_numpy(), MISSING_LABEL)
 
-    for col in numerical_features:
-        X[col] = pd.to_numeric(X[col], errors='coerce')
-        if X[col].isnull().any():
-            X[col].fillna(X[col].median(), inplace=True)
 
+def fit_preprocessor(df: pd.DataFrame, features: list) -> dict:
+    """Fit the prepare_lgb_data encoding on df and return it as a JSON-serializable dict.
+
+    Keys: features (column order), categorical (column -> sorted label strings,
+    the LabelEncoder classes), numerical (column -> median fill value, None
+    when the column has no numeric values).
+    """
+    categorical = {}
+    numerical = {}
+    for col in features:
+        if _is_categorical(df[col]):
+            categorical[col] = sorted(_as_label_strings(df[col]).unique().tolist())
+        else:
+            median = pd.to_numeric(df[col], errors='coerce').median()
+            numerical[col] = None if pd.isna(median) else float(median)
+    return {'features': list(features), 'categorical': categorical, 'numerical': numerical}
+
+
+def transform_features(df: pd.DataFrame, preprocessor: dict) -> pd.DataFrame:
+    """Encode df with a fitted preprocessor; labels not seen in fit become missing categories."""
+    X = pd.DataFrame(index=df.index)
+    for col in preprocessor['features']:
+        if col in preprocessor['categorical']:
+            classes = preprocessor['categorical'][col]
+            codes = pd.Categorical(_as_label_strings(df[col]), categories=classes).codes
+            X[col] = pd.Categorical.from_codes(codes, categories=np.arange(len(classes), dtype=np.int64))
+        else:
+            X[col] = pd.to_numeric(df[col], errors='coerce')
+            fill_value = preprocessor['numerical'][col]
+            if fill_value is not None and X[col].isnull().any():
+                X[col] = X[col].fillna(fill_value)
+    return X
+
+
+def prepare_lgb_data(df: pd.DataFrame, features: list, target: str = 'BID', return_preprocessor: bool = False):
+    """Label-encode categorical features and median-fill numerical ones.
+
+    return_preprocessor=True also returns the fitted preprocessor (see
+    fit_preprocessor), so new candidates can be encoded the same way with
+    transform_features.
+    """
+    preprocessor = fit_preprocessor(df, features)
+    X = transform_features(df, preprocessor)
+    Y = df[target].copy()
+
+    categorical_features = list(preprocessor['categorical'])
+    numerical_features = list(preprocessor['numerical'])
+    if return_preprocessor:
+        return X, Y, categorical_features, numerical_features, preprocessor
     return X, Y, categorical_features, numerical_features
 
 
-def train_lgb_cv(X, Y, categorical_features, params=None, n_splits=4, manual_threshold=0.12):
-    if params is None:
-        params = dict(objective='binary', metric='auc', random_state=42,
-                      n_estimators=317, learning_rate=0.03, num_leaves=31)
+# Parameters that change how features are binned. They are fixed when the fold
+# Datasets are built, so they cannot vary between trials that share the cache.
+DATASET_PARAMS = {
+    'max_bin', 'max_bin_by_feature', 'min_data_in_bin', 'bin_construct_sample_cnt', 'subsample_for_bin',
+    'data_random_seed', 'use_missing', 'zero_as_missing', 'feature_pre_filter', 'linear_tree',
+    'enable_bundle', 'max_cat_to_onehot', 'forcedbins_filename',
+}
 
-    skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
 
-    auc_scores = []
-    f1_scores = []
-    models = []
+def split_dataset_params(params: dict):
+    """Split LightGBM params into (binning params for lgb.Dataset, training params)."""
+    dataset_params = {k: v for k, v in params.items() if k in DATASET_PARAMS}
+    train_params = {k: v for k, v in params.items() if k not in DATASET_PARAMS}
+    return dataset_params, train_params
+
+
+def native_train_params(params: dict):
+    """(binning params, lgb.train params, num_boost_round) from LGBMClassifier-style params.
+
+    n_estimators becomes num_boost_round, random_state becomes seed and
+    verbose defaults to -1 as in LGBMClassifier.
+    """
+    dataset_params, train_params = split_dataset_params(params)
+    train_params = dict(train_params)
+    num_boost_round = train_params.pop('n_estimators', 100)
+    if 'random_state' in train_params:
+        train_params['seed'] = train_params.pop('random_state')
+    # LGBMClassifier passes verbose=-1 unless told otherwise; lgb.train logs [Info] lines
+    if 'verbose' not in train_params and 'verbosity' not in train_params:
+        train_params['verbose'] = -1
+    return dataset_params, train_params, num_boost_round
+
+
+@instrumented()
+def build_fold_datasets(X, Y, categorical_features, n_splits=4, random_state=42, dataset_params=None):
+    """Bin every StratifiedKFold split once so trials and CV runs can reuse it.
+
+    Returns a list of dicts with train_set / valid_set (constructed lgb.Dataset),
+    train_idx / val_idx and X_val (needed for predictions).
+    """
+    # feature_pre_filter depends on min_data_in_leaf, which trials are free to change
+    dataset_params = {'feature_pre_filter': False, 'verbose': -1, **(dataset_params or {})}
+    categorical_feature = [c for c in categorical_features if c in X.columns]
+
+    skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+    folds = []
+    for train_idx, val_idx in skf.split(X, Y):
+        X_val = X.iloc[val_idx]
+        train_set = lgb.Dataset(X.iloc[train_idx], Y.iloc[train_idx], categorical_feature=categorical_feature,
+                                params=dataset_params, free_raw_data=False)
+        valid_set = lgb.Dataset(X_val, Y.iloc[val_idx], reference=train_set, categorical_feature=categorical_feature,
+                                params=dataset_params, free_raw_data=False)
+        train_set.construct()
+        valid_set.construct()
+        folds.append(dict(train_set=train_set, valid_set=valid_set, train_idx=train_idx, val_idx=val_idx, X_val=X_val))
+    return folds
 
-    for fold, (train_idx, val_idx) in enumerate(skf.split(X, Y)):
-        X_train, X_val = X.iloc[train_idx], X.iloc[val_idx]
-        Y_train, Y_val = Y.iloc[train_idx], Y.iloc[val_idx]
 
+def train_fold_booster(fold, params, early_stopping_rounds=100):
+    """Train on a cached fold with the native API; params use the LGBMClassifier names.
+
+    Only tree building happens here: the fold's Datasets are already binned.
+    """
+    dataset_params, train_params, num_boost_round = native_train_params(params)
+    if dataset_params:
+        raise ValueError(f'binning params {sorted(dataset_params)} must be passed to build_fold_datasets')
+
+    return lgb.train(train_params, fold['train_set'], num_boost_round=num_boost_round,
+                     valid_sets=[fold['valid_set']],
+                     callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False)])
+
+
+def threshold_sweep(y_true, y_proba) -> pd.DataFrame:
+    """Precision, recall and F1 at every distinct threshold, from one sorted pass.
+
+    A row with threshold t describes the classifier `y_proba >= t`.
+    """
+    y_true = np.asarray(y_true).astype(int)
+    y_proba = np.asarray(y_proba, dtype=float)
+    order = np.argsort(-y_proba, kind='stable')
+    proba_sorted = y_proba[order]
+
+    tp = np.cumsum(y_true[order])
+    predicted_pos = np.arange(1, len(y_true) + 1)
+    # Only the last position of each run of tied probabilities is a reachable threshold
+    last_of_run = np.r_[proba_sorted[1:] != proba_sorted[:-1], True]
+    tp, predicted_pos = tp[last_of_run], predicted_pos[last_of_run]
+
+    positives = y_true.sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tp / predicted_pos
+        recall = np.where(positives > 0, tp / positives, 0.0)
+        f1 = np.where(predicted_pos + positives > 0, 2 * tp / (predicted_pos + positives), 0.0)
+
+    return pd.DataFrame({'threshold': proba_sorted[last_of_run], 'precision': precision,
+                         'recall': recall, 'f1': f1, 'n_predicted_positive': predicted_pos})
+
+
+def _fit_fold(X, Y, categorical_features, params, train_idx, val_idx, fold_data=None, fold=None):
+    with span('train_lgb_cv.fold', fold=fold, rows_in=len(train_idx), cols_in=X.shape[1]):
+        return _fit_fold_inner(X, Y, categorical_features, params, train_idx, val_idx, fold_data)
+
+
+def _fit_fold_inner(X, Y, categorical_features, params, train_idx, val_idx, fold_data):
+    X_train, X_val = X.iloc[train_idx], X.iloc[val_idx]
+    Y_train, Y_val = Y.iloc[train_idx], Y.iloc[val_idx]
+
+    if fold_data is None:
         clf = lgb.LGBMClassifier(**params)
         clf.fit(X_train, Y_train,
                 eval_set=[(X_val, Y_val)],
@@ -58,9 +216,63 @@ def train_lgb_cv(X, Y, categorical_features, params=None, n_splits=4, manual_thr
                 callbacks=[lgb.early_stopping(100, verbose=False)],
                 categorical_feature=[c for c in categorical_features if c in X_train.columns]
                )
+        return clf, clf.predict_proba(X_val)[:, 1]
+
+    clf = train_fold_booster(fold_data, params)
+    return clf, clf.predict(X_val, num_iteration=clf.best_iteration)
+
+
+@instrumented()
+def train_lgb_cv(X, Y, categorical_features, params=None, n_splits=4, manual_threshold=0.12, fold_datasets=None,
+                 n_jobs=1, threads_per_fold=None):
+    """Cross-validate LightGBM; returns (models, metrics).
+
+    fold_datasets: output of build_fold_datasets. When given, the cached binned
+    folds are trained with the native API (models are lgb.Booster) instead of
+    re-binning every fold through LGBMClassifier.
+    n_jobs: folds trained concurrently (-1 = one per fold, up to the core count).
+    threads_per_fold: LightGBM threads per fold; defaults to cores // concurrent
+    folds when n_jobs != 1 so folds do not oversubscribe the CPU.
+
+    metrics also holds 'oof_proba' (out-of-fold probabilities for every row)
+    and 'threshold_sweep' (threshold_sweep over the OOF vector), so other
+    thresholds can be evaluated without retraining.
+    """
+    if params is None:
+        params = dict(objective='binary', metric='auc', random_state=42,
+                      n_estimators=317, learning_rate=0.03, num_leaves=31)
+
+    if fold_datasets is None:
+        skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
+        splits = list(skf.split(X, Y))
+    else:
+        splits = [(fold['train_idx'], fold['val_idx']) for fold in fold_datasets]
+
+    n_workers = min(resolve_n_jobs(n_jobs), len(splits))
+    if threads_per_fold is None and n_workers > 1:
+        threads_per_fold = max(1, (os.cpu_count() or 1) // n_workers)
+    if threads_per_fold is not None:
+        params = {**params, 'n_jobs': threads_per_fold}
+
+    fold_args = [(X, Y, categorical_features, params, train_idx, val_idx,
+                  None if fold_datasets is None else fold_datasets[fold], fold)
+                 for fold, (train_idx, val_idx) in enumerate(splits)]
+    if n_workers > 1:
+        # LightGBM releases the GIL while training, so threads are enough here
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            fold_results = list(executor.map(lambda args: _fit_fold(*args), fold_args))
+    else:
+        fold_results = [_fit_fold(*args) for args in fold_args]
+
+    auc_scores = []
+    f1_scores = []
+    models = []
+    oof_proba = np.full(len(X), np.nan)
 
-        y_pred_proba = clf.predict_proba(X_val)[:, 1]
+    for (train_idx, val_idx), (clf, y_pred_proba) in zip(splits, fold_results):
+        Y_val = Y.iloc[val_idx]
         y_pred = (y_pred_proba >= manual_threshold).astype(int)
+        oof_proba[val_idx] = y_pred_proba
 
         auc = roc_auc_score(Y_val, y_pred_proba)
         f1 = f1_score(Y_val, y_pred)
@@ -75,7 +287,9 @@ def train_lgb_cv(X, Y, categorical_features, params=None, n_splits=4, manual_thr
         'f1_mean': np.mean(f1_scores),
         'f1_std': np.std(f1_scores),
         'fold_aucs': auc_scores,
-        'fold_f1s': f1_scores
+        'fold_f1s': f1_scores,
+        'oof_proba': oof_proba,
+        'threshold_sweep': threshold_sweep(Y, oof_proba),
     }
 
     return models, metrics
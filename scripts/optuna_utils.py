@@ -1,47 +1,136 @@
 """Optuna helper for LightGBM hyperparameter search."""
 
+from concurrent.futures import ProcessPoolExecutor
+
 import optuna
 import lightgbm as lgb
 from sklearn.model_selection import StratifiedKFold
 from sklearn.metrics import roc_auc_score
 import numpy as np
 
+from scripts.model import build_fold_datasets, train_fold_booster
+from scripts.instrument import instrumented, span
+from scripts.utils import resolve_n_jobs
+
+
+def _resolve_storage(storage):
+    """None -> in-memory, 'dialect://...' -> RDB URL (e.g. sqlite:///optuna.db), other strings -> journal file."""
+    if storage is None or not isinstance(storage, str) or '://' in storage:
+        return storage
+    from optuna.storages import JournalStorage
+    try:
+        from optuna.storages.journal import JournalFileBackend
+    except ImportError:  # optuna < 4.0
+        from optuna.storages import JournalFileStorage as JournalFileBackend
+    return JournalStorage(JournalFileBackend(storage))
+
 
-def optuna_search(X, Y, categorical_features, n_trials=50, n_splits=4, random_state=42):
-    skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+def _objective(trial, X, Y, categorical_features, n_splits, random_state, fold_datasets=None):
+    with span('optuna_search.trial', trial=trial.number, rows_in=len(X), cols_in=X.shape[1]):
+        return _trial_auc(trial, X, Y, categorical_features, n_splits, random_state, fold_datasets)
 
-    def objective(trial):
-        params = {
-            'objective': 'binary',
-            'metric': 'auc',
-            'random_state': random_state,
-            'n_estimators': trial.suggest_int('n_estimators', 50, 1000),
-            'learning_rate': trial.suggest_float('learning_rate', 0.01, 0.3, log=True),
-            'num_leaves': trial.suggest_int('num_leaves', 2, 256),
-            'max_depth': trial.suggest_int('max_depth', 2, 64),
-            'reg_alpha': trial.suggest_float('reg_alpha', 1e-8, 10.0, log=True),
-            'reg_lambda': trial.suggest_float('reg_lambda', 1e-8, 10.0, log=True),
-            'colsample_bytree': trial.suggest_float('colsample_bytree', 0.4, 1.0),
-            'subsample': trial.suggest_float('subsample', 0.4, 1.0),
-        }
 
-        oof_preds = np.zeros(len(X))
+def _trial_auc(trial, X, Y, categorical_features, n_splits, random_state, fold_datasets):
+    params = {
+        'objective': 'binary',
+        'metric': 'auc',
+        'random_state': random_state,
+        'n_estimators': trial.suggest_int('n_estimators', 50, 1000),
+        'learning_rate': trial.suggest_float('learning_rate', 0.01, 0.3, log=True),
+        'num_leaves': trial.suggest_int('num_leaves', 2, 256),
+        'max_depth': trial.suggest_int('max_depth', 2, 64),
+        'reg_alpha': trial.suggest_float('reg_alpha', 1e-8, 10.0, log=True),
+        'reg_lambda': trial.suggest_float('reg_lambda', 1e-8, 10.0, log=True),
+        'colsample_bytree': trial.suggest_float('colsample_bytree', 0.4, 1.0),
+        'subsample': trial.suggest_float('subsample', 0.4, 1.0),
+    }
 
-        for train_idx, val_idx in skf.split(X, Y):
-            X_tr, X_val = X.iloc[train_idx], X.iloc[val_idx]
-            y_tr, y_val = Y.iloc[train_idx], Y.iloc[val_idx]
+    if fold_datasets is None:
+        skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=random_state)
+        splits = list(skf.split(X, Y))
+    else:
+        splits = [(fold['train_idx'], fold['val_idx']) for fold in fold_datasets]
+    oof_preds = np.zeros(len(X))
 
+    for fold, (train_idx, val_idx) in enumerate(splits):
+        X_val, y_val = X.iloc[val_idx], Y.iloc[val_idx]
+
+        if fold_datasets is None:
+            X_tr, y_tr = X.iloc[train_idx], Y.iloc[train_idx]
             model = lgb.LGBMClassifier(**params)
             model.fit(X_tr, y_tr,
                       eval_set=[(X_val, y_val)],
                       eval_metric='auc',
                       callbacks=[lgb.early_stopping(100, verbose=False)],
                       categorical_feature=categorical_features)
-
             oof_preds[val_idx] = model.predict_proba(X_val)[:, 1]
+        else:
+            booster = train_fold_booster(fold_datasets[fold], params)
+            oof_preds[val_idx] = booster.predict(X_val, num_iteration=booster.best_iteration)
+
+        # Report the fold AUC so the pruner can stop hopeless trials after the first folds
+        trial.report(roc_auc_score(y_val, oof_preds[val_idx]), step=fold)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+
+    return roc_auc_score(Y, oof_preds)
+
+
+def _optimize_worker(storage, study_name, n_trials, X, Y, categorical_features, n_splits, random_state,
+                     cache_datasets, dataset_params, pruner, sampler):
+    # lgb.Dataset objects cannot be pickled, so every worker bins its own copy once
+    fold_datasets = (build_fold_datasets(X, Y, categorical_features, n_splits, random_state, dataset_params)
+                     if cache_datasets else None)
+    # The pruner and sampler live on the Study object, not in storage, so each worker needs them again
+    study = optuna.load_study(study_name=study_name, storage=_resolve_storage(storage), pruner=pruner,
+                              sampler=sampler)
+    study.optimize(lambda trial: _objective(trial, X, Y, categorical_features, n_splits, random_state, fold_datasets),
+                   n_trials=n_trials)
+
+
+@instrumented()
+def optuna_search(X, Y, categorical_features, n_trials=50, n_splits=4, random_state=42,
+                  pruner=None, storage=None, study_name=None, n_jobs=1,
+                  cache_datasets=False, dataset_params=None, sampler=None):
+    """Search LightGBM hyperparameters, maximizing out-of-fold AUC.
+
+    pruner: an optuna pruner fed with each fold's AUC (None -> optuna's default MedianPruner).
+    sampler: an optuna sampler (None -> optuna's default TPESampler). The pruner
+        and sampler are pickled into every worker process when n_jobs > 1.
+    storage: None for an in-memory study, an RDB URL such as 'sqlite:///optuna.db',
+        or a file path for a journal-file study. With a storage the study is
+        resumable: n_trials is the total target, and trials already finished
+        (complete or pruned) under study_name count towards it.
+    n_jobs: worker processes sharing the study through storage (-1 = all cores).
+    cache_datasets: bin each fold once (build_fold_datasets) and train every trial
+        on the cached lgb.Dataset with the native API; dataset_params (max_bin, ...)
+        are fixed for the whole search.
+    """
+    if study_name is None and storage is not None:
+        study_name = 'optuna_search'
+
+    study = optuna.create_study(direction='maximize', pruner=pruner, sampler=sampler,
+                                storage=_resolve_storage(storage), study_name=study_name, load_if_exists=True)
+
+    finished = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED))
+    remaining = max(0, n_trials - len(finished))
 
-        return roc_auc_score(Y, oof_preds)
+    n_workers = min(resolve_n_jobs(n_jobs), remaining)
+    if n_workers > 1:
+        if storage is None:
+            raise ValueError('n_jobs > 1 needs a file-backed storage shared by the worker processes')
+        per_worker = [len(chunk) for chunk in np.array_split(np.arange(remaining), n_workers)]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_optimize_worker, storage, study_name, n, X, Y, categorical_features,
+                                       n_splits, random_state, cache_datasets, dataset_params, pruner, sampler)
+                       for n in per_worker]
+            for future in futures:
+                future.result()
+    elif remaining:
+        fold_datasets = (build_fold_datasets(X, Y, categorical_features, n_splits, random_state, dataset_params)
+                         if cache_datasets else None)
+        study.optimize(lambda trial: _objective(trial, X, Y, categorical_features, n_splits, random_state,
+                                                fold_datasets),
+                       n_trials=remaining)
 
-    study = optuna.create_study(direction='maximize')
-    study.optimize(objective, n_trials=n_trials)
     return study
@@ -0,0 +1,351 @@
+"""End-to-end builders for the per-candidate dataset.
+
+Functions:
+- build_final_dataset(df_mendan, df_oubo, df_seiyaku, backend='pandas', vectorized=False, compact=False) -> df_final
+- run_pipeline(sources, targets=('strengths',), params=None, cache_dir='.pipeline_cache', max_cache_mb=None,
+  force=()) -> (outputs, statuses)
+- evict_cache(cache_dir, max_cache_mb) -> list of removed cache files
+
+run_pipeline runs the stages as a DAG:
+
+    mendan, oubo -> merged -> deltas -> features -> final (+ seiyaku) -> cp_frames -> strengths
+                                                                      -> model
+
+Every stage output is memoized under a key that hashes the stage name, the
+source files of the stage function's module and of every scripts.* module it
+imports (transitively), the stage's own parameters and the keys of
+its inputs (the sources are hashed by content). Changing a parameter
+therefore only invalidates that stage and the stages after it. DataFrames
+are cached as parquet, other outputs as pickle; the cache is trimmed to
+max_cache_mb by evicting the least recently used entries.
+
+Command line:
+    python -m scripts.pipeline --mendan 面談.xlsx --oubo 応募.csv --seiyaku 成約.xlsx \\
+        --targets strengths model --set vectorized=true --set engine='"batched"'
+"""
+
+import argparse
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import pickle
+
+import pandas as pd
+
+from scripts.feature_engineering import create_features
+from scripts.instrument import instrumented
+from scripts.preprocessing import add_time_deltas, finalize_dataset, preprocess_merge
+from scripts.utils import frame_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+@instrumented()
+def build_final_dataset(df_mendan, df_oubo, df_seiyaku, backend='pandas', vectorized=False, compact=False):
+    """Run preprocess_merge -> add_time_deltas -> create_features -> finalize_dataset.
+
+    backend='pandas' calls the stage functions in scripts/ one after another.
+    backend='polars' runs the same stages as one Polars lazy query (see
+    scripts.polars_backend) and converts the result back to pandas, so the
+    output can be passed to split_by_cp / run_mannwhitney_tests / prepare_lgb_data
+    unchanged. vectorized and compact only apply to the pandas backend.
+    """
+    if backend == 'polars':
+        from scripts.polars_backend import build_final_dataset as build_with_polars
+        return build_with_polars(df_mendan, df_oubo, df_seiyaku)
+    if backend != 'pandas':
+        raise ValueError(f"backend must be 'pandas' or 'polars', got {backend!r}")
+
+    df_merge_diff = preprocess_merge(df_mendan, df_oubo, compact=compact)
+    df_merge_diff = add_time_deltas(df_merge_diff, df_mendan, df_oubo, vectorized=vectorized, compact=compact)
+    df_merge_diff = create_features(df_merge_diff, vectorized=vectorized, compact=compact)
+    return finalize_dataset(df_merge_diff, df_mendan, df_oubo, df_seiyaku, compact=compact)
+
+
+SOURCES = ['mendan', 'oubo', 'seiyaku']
+
+FEATURES_TO_TEST = ['業種', '職種', '転職経験', '登録経路（大）', '転職温度感', '現在住所']
+MODEL_FEATURES = ['業種', '職種', '人材ランク_x', '転職経験', '登録経路（大）', 'ランクギャップ', 'エントリー数',
+                  'エントリー業種一致率', '平均年収ギャップ＋', '現在年収', '登録→面談日数', '担当CP']
+
+DEFAULT_PARAMS = {
+    'vectorized': False,
+    'compact': False,
+    'min_rows': 10,
+    'max_rows': 200,
+    'features_to_test': FEATURES_TO_TEST,
+    'engine': 'scipy',
+    'model_features': MODEL_FEATURES,
+    'lgb_params': None,
+    'n_splits': 4,
+    'manual_threshold': 0.12,
+}
+
+
+def _run_split(final, min_rows, max_rows):
+    from scripts.utils import split_by_cp
+    return split_by_cp(final, min_rows=min_rows, max_rows=max_rows)
+
+
+def _run_tests(cp_frames, features_to_test, engine):
+    from scripts.u_test import run_mannwhitney_tests
+    return run_mannwhitney_tests(cp_frames, features_to_test, engine=engine)
+
+
+def _run_model(final, model_features, lgb_params, n_splits, manual_threshold):
+    from scripts.model import prepare_lgb_data, train_lgb_cv
+    features = [f for f in model_features if f in final.columns]
+    X, Y, categorical_features, _, preprocessor = prepare_lgb_data(final, features, return_preprocessor=True)
+    models, metrics = train_lgb_cv(X, Y, categorical_features, params=lgb_params, n_splits=n_splits,
+                                   manual_threshold=manual_threshold)
+    return {'models': models, 'metrics': metrics, 'preprocessor': preprocessor}
+
+
+# stage -> (function, input stages, parameter names); inputs are passed positionally, parameters by keyword
+PIPELINE_STAGES = {
+    'merged': (preprocess_merge, ['mendan', 'oubo'], ['compact']),
+    'deltas': (add_time_deltas, ['merged', 'mendan', 'oubo'], ['vectorized', 'compact']),
+    'features': (create_features, ['deltas'], ['vectorized', 'compact']),
+    'final': (finalize_dataset, ['features', 'mendan', 'oubo', 'seiyaku'], ['compact']),
+    'cp_frames': (_run_split, ['final'], ['min_rows', 'max_rows']),
+    'strengths': (_run_tests, ['cp_frames'], ['features_to_test', 'engine']),
+    'model': (_run_model, ['final'], ['model_features', 'lgb_params', 'n_splits', 'manual_threshold']),
+}
+
+_SOURCE_FILES = {
+    '_run_split': 'scripts.utils', '_run_tests': 'scripts.u_test', '_run_model': 'scripts.model',
+}
+
+
+def _hash_file(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _hash_source(source):
+    if isinstance(source, (str, os.PathLike)):
+        return _hash_file(source)
+    return frame_hash(source)
+
+
+def _scripts_imports(path):
+    """scripts.* modules imported anywhere in a file (function-local imports included)."""
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names if alias.name.startswith('scripts.'))
+        elif isinstance(node, ast.ImportFrom) and node.module and node.module.startswith('scripts.'):
+            modules.add(node.module)
+    return modules
+
+
+def _module_files(modules):
+    """Source files of modules and of every scripts.* module they import, transitively."""
+    files = {}
+    pending = list(modules)
+    while pending:
+        module = pending.pop()
+        if module in files:
+            continue
+        spec = importlib.util.find_spec(module)
+        files[module] = spec.origin
+        # The runner itself is not a dependency of the stages it wraps
+        pending.extend(m for m in _scripts_imports(spec.origin) if m != __name__)
+    return [files[module] for module in sorted(files)]
+
+
+def _code_hash(fn):
+    """Hash of the stage function's module and its transitive scripts.* imports, so code changes invalidate the cache.
+
+    Stage wrappers defined in this module are hashed through the module in
+    _SOURCE_FILES (plus this file) instead of everything this module imports.
+    """
+    fn = inspect.unwrap(fn)
+    if fn.__module__ == __name__:
+        files = [inspect.getsourcefile(fn)] + _module_files([_SOURCE_FILES[fn.__name__]])
+    else:
+        files = _module_files([fn.__module__])
+    return hashlib.sha256(b''.join(_hash_file(path).encode() for path in files)).hexdigest()
+
+
+def _stage_keys(sources, params):
+    keys = {name: _hash_source(sources[name]) for name in SOURCES}
+    for stage, (fn, inputs, param_names) in PIPELINE_STAGES.items():
+        payload = {
+            'stage': stage,
+            'code': _code_hash(fn),
+            'params': {name: params[name] for name in param_names},
+            'inputs': [keys[name] for name in inputs],
+        }
+        keys[stage] = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False,
+                                                default=str).encode()).hexdigest()[:32]
+    return keys
+
+
+def _load_source(source):
+    if not isinstance(source, (str, os.PathLike)):
+        return source
+    path = str(source)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith(('.xlsx', '.xls')):
+        return pd.read_excel(path)
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    return pd.read_csv(path)
+
+
+def _cache_paths(cache_dir, stage, key):
+    base = os.path.join(cache_dir, f'{stage}-{key}')
+    return base + '.parquet', base + '.cp.parquet', base + '.pkl'
+
+
+def _save(cache_dir, stage, key, value):
+    parquet_path, frames_path, pickle_path = _cache_paths(cache_dir, stage, key)
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        if isinstance(value, pd.DataFrame):
+            value.to_parquet(parquet_path)
+            return
+        if isinstance(value, list) and value and all(isinstance(v, pd.DataFrame) for v in value):
+            # split_by_cp output: one parquet with the part number of every row
+            pd.concat(value, keys=range(len(value)), names=['_part']).to_parquet(frames_path)
+            return
+    except Exception:
+        # Columns parquet cannot store (e.g. mixed str/float objects) fall back to pickle
+        for path in (parquet_path, frames_path):
+            if os.path.exists(path):
+                os.remove(path)
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load(cache_dir, stage, key):
+    """Cached value or None; touches the file so eviction is least recently used."""
+    parquet_path, frames_path, pickle_path = _cache_paths(cache_dir, stage, key)
+    if os.path.exists(parquet_path):
+        os.utime(parquet_path)
+        return pd.read_parquet(parquet_path)
+    if os.path.exists(frames_path):
+        os.utime(frames_path)
+        combined = pd.read_parquet(frames_path)
+        return [part.droplevel('_part') for _, part in combined.groupby(level='_part', sort=True)]
+    if os.path.exists(pickle_path):
+        os.utime(pickle_path)
+        with open(pickle_path, 'rb') as f:
+            return pickle.load(f)
+    return None
+
+
+def evict_cache(cache_dir, max_cache_mb):
+    """Delete the least recently used cache files until the directory is at most max_cache_mb."""
+    if max_cache_mb is None or not os.path.isdir(cache_dir):
+        return []
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+    entries = sorted((path for path in entries if os.path.isfile(path)), key=os.path.getmtime)
+    total = sum(os.path.getsize(path) for path in entries)
+    removed = []
+    for path in entries:
+        if total <= max_cache_mb * 1024 ** 2:
+            break
+        total -= os.path.getsize(path)
+        os.remove(path)
+        removed.append(path)
+    return removed
+
+
+def run_pipeline(sources, targets=('strengths',), params=None, cache_dir='.pipeline_cache', max_cache_mb=None,
+                 force=()):
+    """Compute the target stages, reusing memoized stage outputs from cache_dir.
+
+    sources: {'mendan': ..., 'oubo': ..., 'seiyaku': ...}, DataFrames or file
+        paths (parquet / csv / xlsx / pkl).
+    params: overrides of DEFAULT_PARAMS.
+    force: stages to recompute even when cached.
+
+    Returns (outputs, statuses): outputs maps each target to its value;
+    statuses maps every visited stage to 'cached' or 'computed'.
+    """
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    unknown = (set(targets) | set(force)) - set(PIPELINE_STAGES)
+    if unknown:
+        raise ValueError(f'unknown stages: {sorted(unknown)}')
+
+    keys = _stage_keys(sources, params)
+    values = {}
+    statuses = {}
+
+    def get(name):
+        if name in values:
+            return values[name]
+        if name in SOURCES:
+            values[name] = _load_source(sources[name])
+            return values[name]
+
+        value = None if name in force else _load(cache_dir, name, keys[name])
+        if value is not None:
+            statuses[name] = 'cached'
+        else:
+            fn, inputs, param_names = PIPELINE_STAGES[name]
+            value = fn(*[get(i) for i in inputs], **{p: params[p] for p in param_names})
+            _save(cache_dir, name, keys[name], value)
+            statuses[name] = 'computed'
+        logger.info('%s: %s (%s)', name, statuses[name], keys[name])
+        values[name] = value
+        return value
+
+    outputs = {target: get(target) for target in targets}
+    evict_cache(cache_dir, max_cache_mb)
+    return outputs, statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the CP distribution pipeline with memoized stages.')
+    parser.add_argument('--mendan', required=True, help='面談 sheet (parquet / csv / xlsx / pkl)')
+    parser.add_argument('--oubo', required=True, help='応募 sheet')
+    parser.add_argument('--seiyaku', required=True, help='成約 sheet')
+    parser.add_argument('--targets', nargs='+', default=['strengths'], choices=list(PIPELINE_STAGES))
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=JSON',
+                        help='parameter override, e.g. --set vectorized=true --set min_rows=20')
+    parser.add_argument('--cache-dir', default='.pipeline_cache')
+    parser.add_argument('--max-cache-mb', type=float, default=None)
+    parser.add_argument('--force', nargs='*', default=[], choices=list(PIPELINE_STAGES))
+    parser.add_argument('--export', help='directory to write the target outputs to')
+    args = parser.parse_args(argv)
+
+    params = {}
+    for item in args.set:
+        name, _, raw = item.partition('=')
+        if name not in DEFAULT_PARAMS:
+            parser.error(f'unknown parameter {name!r}; choose from {sorted(DEFAULT_PARAMS)}')
+        params[name] = json.loads(raw)
+
+    sources = {'mendan': args.mendan, 'oubo': args.oubo, 'seiyaku': args.seiyaku}
+    outputs, statuses = run_pipeline(sources, targets=args.targets, params=params, cache_dir=args.cache_dir,
+                                     max_cache_mb=args.max_cache_mb, force=args.force)
+    for stage, status in statuses.items():
+        print(f'{stage}: {status}')
+
+    if args.export:
+        os.makedirs(args.export, exist_ok=True)
+        for target, value in outputs.items():
+            if isinstance(value, pd.DataFrame):
+                value.to_csv(os.path.join(args.export, f'{target}.csv'), index=False)
+            else:
+                with open(os.path.join(args.export, f'{target}.pkl'), 'wb') as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
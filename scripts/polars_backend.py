@@ -0,0 +1,228 @@
+"""Polars execution backend for the tabular pipeline.
+
+Mirrors the pandas stages on Polars lazy frames, so joins and group-bys run
+multi-threaded and the whole preprocess_merge -> add_time_deltas ->
+create_features -> finalize_dataset chain is optimized as one query plan
+(column pruning for the drop lists, predicate pushdown for the filters).
+
+Functions:
+- preprocess_merge(df_mendan, df_oubo, excluded_mendan_cols=None, columns_to_drop=None, rename_map=None) -> LazyFrame
+- add_time_deltas(lf, df_mendan, df_oubo) -> LazyFrame
+- create_features(lf) -> LazyFrame
+- finalize_dataset(lf, df_mendan, df_oubo, df_seiyaku) -> LazyFrame
+- build_final_dataset(df_mendan, df_oubo, df_seiyaku) -> pandas DataFrame
+
+Inputs may be pandas DataFrames, pyarrow Tables or Polars frames.
+"""
+
+from scripts.feature_engineering import INTERIM_COLUMNS, RANK_MAPPING
+from scripts.instrument import instrumented
+from scripts.preprocessing import COLUMNS_TO_DROP, DROPNA_EXCLUDED_COLS, EXCLUDED_MENDAN_COLS, RENAME_MAP
+
+
+def _import_polars():
+    try:
+        import polars as pl
+    except Exception as e:
+        raise ImportError('polars is required for the polars backend: pip install polars pyarrow') from e
+    return pl
+
+
+def _to_lazy(data):
+    pl = _import_polars()
+    if isinstance(data, pl.LazyFrame):
+        return data
+    if isinstance(data, pl.DataFrame):
+        return data.lazy()
+    if hasattr(data, 'iloc'):
+        return pl.from_pandas(data, nan_to_null=True).lazy()
+    return pl.from_arrow(data).lazy()
+
+
+def _columns(lf):
+    return lf.collect_schema().names()
+
+
+def _left_join(left, right, on):
+    # pandas merge(how='left') keeps the left row order
+    return left.join(right, on=on, how='left', maintain_order='left')
+
+
+def _as_datetime(pl, lf, col):
+    dtype = lf.collect_schema()[col]
+    if dtype == pl.String:
+        return pl.col(col).str.to_datetime(strict=False)
+    if dtype == pl.Date:
+        return pl.col(col).cast(pl.Datetime)
+    return pl.col(col)
+
+
+def preprocess_merge(df_mendan, df_oubo, excluded_mendan_cols=None, columns_to_drop=None, rename_map=None):
+    """Polars version of preprocessing.preprocess_merge.
+
+    Overlapping columns get pandas' _x/_y suffixes, so the drop list and
+    rename map apply unchanged.
+    """
+    pl = _import_polars()
+    if excluded_mendan_cols is None:
+        excluded_mendan_cols = EXCLUDED_MENDAN_COLS
+    if columns_to_drop is None:
+        columns_to_drop = COLUMNS_TO_DROP
+    if rename_map is None:
+        rename_map = RENAME_MAP
+
+    oubo = _to_lazy(df_oubo)
+    mendan = _to_lazy(df_mendan)
+
+    mendan_cols_to_keep = [col for col in _columns(mendan) if col not in excluded_mendan_cols or col == '求職者ID']
+    oubo_cols = _columns(oubo)
+    overlap = [col for col in mendan_cols_to_keep if col in oubo_cols and col != '求職者ID']
+
+    oubo = oubo.rename({col: f'{col}_x' for col in overlap})
+    mendan = mendan.select(mendan_cols_to_keep).rename({col: f'{col}_y' for col in overlap})
+
+    # Prune dropped columns on each side before the join
+    oubo = oubo.drop([col for col in _columns(oubo) if col in columns_to_drop and col != '求職者ID'])
+    mendan = mendan.drop([col for col in _columns(mendan) if col in columns_to_drop and col != '求職者ID'])
+
+    merged = _left_join(oubo, mendan, on='求職者ID')
+    merged = merged.rename({k: v for k, v in rename_map.items() if k in _columns(merged)})
+
+    columns_for_dropna_subset = [col for col in _columns(merged) if col not in DROPNA_EXCLUDED_COLS]
+    float_cols = [col for col, dtype in merged.collect_schema().items()
+                  if col in columns_for_dropna_subset and dtype.is_float()]
+    merged = merged.drop_nulls(subset=columns_for_dropna_subset)
+    if float_cols:
+        merged = merged.filter(pl.all_horizontal([pl.col(col).is_not_nan() for col in float_cols]))
+    return merged
+
+
+def add_time_deltas(lf, df_mendan, df_oubo):
+    """Polars version of preprocessing.add_time_deltas."""
+    pl = _import_polars()
+    lf = _to_lazy(lf)
+    sources = [('データ登録日', df_mendan), ('求職者面談日時', df_mendan), ('応募承諾週', df_oubo), ('１次面接日', df_oubo)]
+    for col, source in sources:
+        if col not in _columns(lf) and col in _columns(_to_lazy(source)):
+            lf = _left_join(lf, _to_lazy(source).select(['求職者ID', col]), on='求職者ID')
+
+    date_cols = ['データ登録日', '求職者面談日時', '応募承諾週', '１次面接日']
+    lf = lf.with_columns([_as_datetime(pl, lf, col) for col in date_cols if col in _columns(lf)])
+
+    def days(end, start):
+        # Negative deltas are clipped to 0, so truncating vs flooring the day count does not matter
+        delta = (pl.col(end) - pl.col(start)).dt.total_days()
+        return delta.clip(lower_bound=0).fill_null(0).cast(pl.Int64)
+
+    return lf.with_columns(
+        days('求職者面談日時', 'データ登録日').alias('登録→面談日数'),
+        days('応募承諾週', '求職者面談日時').alias('面談→応募承諾日数'),
+        days('１次面接日', '応募承諾週').alias('応募承諾→1面日数'),
+        days('応募承諾週', 'データ登録日').alias('登録→応募承諾日数'),
+    )
+
+
+def create_features(lf):
+    """Polars version of feature_engineering.create_features.
+
+    Negative 転職回数 values become null in 転職経験 (the pandas path keeps the number).
+    """
+    pl = _import_polars()
+    lf = _to_lazy(lf)
+    cols = _columns(lf)
+    new_cols = []
+
+    if '転職回数' in cols:
+        new_cols.append(pl.when(pl.col('転職回数') == 0).then(pl.lit('転職なし'))
+                        .when(pl.col('転職回数') >= 1).then(pl.lit('転職1回以上'))
+                        .otherwise(None).alias('転職経験'))
+
+    if '人材ランク_x' in cols and '案件ランク' in cols:
+        def rank(col):
+            return pl.col(col).cast(pl.String).replace_strict(RANK_MAPPING, default=None, return_dtype=pl.Int64)
+        new_cols.append((rank('案件ランク') - rank('人材ランク_x')).alias('ランクギャップ'))
+
+    if '登録経路' in cols:
+        route = pl.col('登録経路').cast(pl.String)
+        new_cols.append(pl.when(route.str.contains('（スカウト）', literal=True)).then(pl.lit('スカウト'))
+                        .when(route.str.contains('（新規会員）', literal=True)).then(pl.lit('新規'))
+                        .when(route.str.contains('（案件応募）', literal=True)).then(pl.lit('案件'))
+                        .otherwise(pl.lit('他')).alias('登録経路（大）'))
+
+    if '現在年収' in cols and '求人年収上限（単位：万円）' in cols:
+        new_cols.append((pl.col('求人年収上限（単位：万円）') - pl.col('現在年収')).fill_null(0).cast(pl.Int64).alias('年収ギャップ＋'))
+    if '現在年収' in cols and '求人年収下限（単位：万円）' in cols:
+        new_cols.append((pl.col('現在年収') - pl.col('求人年収下限（単位：万円）')).fill_null(0).cast(pl.Int64).alias('年収ギャップー'))
+
+    def match(value_col, experienced_col):
+        experienced = pl.col(experienced_col).cast(pl.String).str.split(',').list.eval(pl.element().str.strip_chars())
+        return experienced.list.contains(pl.col(value_col).cast(pl.String)).fill_null(False).cast(pl.Int64)
+
+    if '業種' in cols and '経験業種' in cols:
+        new_cols.append(match('業種', '経験業種').alias('業種一致'))
+    if '職種' in cols and 'コア経験職種_x' in cols:
+        new_cols.append(match('職種', 'コア経験職種_x').alias('職種一致'))
+
+    lf = lf.with_columns(new_cols)
+    cols = _columns(lf)
+
+    if '求職者ID' in cols:
+        entries = pl.len().cast(pl.Int64)
+        aggs = [entries.alias('エントリー数')]
+        industry = pl.col('業種一致').sum() if '業種一致' in cols else entries
+        aggs.append((industry / entries).fill_nan(0).alias('エントリー業種一致率'))
+        if '職種一致' in cols:
+            aggs.append((pl.col('職種一致').sum() / entries).fill_nan(0).alias('エントリー職種一致率'))
+        if '年収ギャップ＋' in cols:
+            aggs.append(pl.col('年収ギャップ＋').mean().alias('平均年収ギャップ＋'))
+        if '年収ギャップー' in cols:
+            aggs.append(pl.col('年収ギャップー').mean().alias('平均年収ギャップー'))
+        agg = lf.group_by('求職者ID').agg(aggs)
+
+        if '紹介経路' in cols:
+            # Most frequent route, ties -> smallest value (as Series.mode()[0])
+            mode_route = (lf.filter(pl.col('紹介経路').is_not_null())
+                          .group_by(['求職者ID', '紹介経路']).agg(pl.len().alias('_count'))
+                          .sort(['求職者ID', '_count', '紹介経路'], descending=[False, True, False])
+                          .unique(subset=['求職者ID'], keep='first', maintain_order=True)
+                          .select(['求職者ID', pl.col('紹介経路').alias('メイン紹介経路')]))
+            agg = agg.join(mode_route, on='求職者ID', how='left')
+
+        lf = _left_join(lf, agg, on='求職者ID')
+
+    return lf.drop([col for col in INTERIM_COLUMNS if col in _columns(lf)])
+
+
+def finalize_dataset(lf, df_mendan, df_oubo, df_seiyaku):
+    """Polars version of preprocessing.finalize_dataset."""
+    pl = _import_polars()
+    lf = _to_lazy(lf)
+    cols = _columns(lf)
+
+    lf = lf.unique(subset=['求職者ID'], keep='first', maintain_order=True)
+    if '現在年収' in cols:
+        lf = lf.filter(pl.col('現在年収') < 600)
+    if 'メイン紹介経路' in cols:
+        lf = lf.filter(pl.col('メイン紹介経路') == 'CP厳選')
+    if 'エントリー数' in cols:
+        lf = lf.filter(pl.col('エントリー数') <= 100)
+
+    seiyaku = _to_lazy(df_seiyaku)
+    if {'求職者ID', 'BID'}.issubset(_columns(seiyaku)):
+        bid = seiyaku.select(['求職者ID', 'BID'])
+        lf = _left_join(lf, bid, on='求職者ID')
+        lf = lf.with_columns(
+            (pl.col('BID').cast(pl.Float64).fill_nan(0).fill_null(0).cast(pl.Int64) != 0).cast(pl.Int64).alias('BID'))
+    return lf
+
+
+@instrumented('polars.build_final_dataset')
+def build_final_dataset(df_mendan, df_oubo, df_seiyaku):
+    """Run the four stages as one lazy query and return df_final as a pandas DataFrame."""
+    # Convert each input once; the stages reuse the lazy frames
+    df_mendan, df_oubo, df_seiyaku = _to_lazy(df_mendan), _to_lazy(df_oubo), _to_lazy(df_seiyaku)
+    lf = preprocess_merge(df_mendan, df_oubo)
+    lf = add_time_deltas(lf, df_mendan, df_oubo)
+    lf = create_features(lf)
+    lf = finalize_dataset(lf, df_mendan, df_oubo, df_seiyaku)
+    return lf.collect().to_pandas()
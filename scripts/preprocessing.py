@@ -1,79 +1,242 @@
 """Preprocessing utilities extracted from the notebook.
 
 Functions:
-- preprocess_merge(df_mendan, df_oubo, excluded_mendan_cols=None, columns_to_drop=None, rename_map=None)
-- add_time_deltas(df_merge_diff, df_mendan, df_oubo)
-- finalize_dataset(df_merge_diff, df_mendan, df_oubo, df_seiyaku)
+- preprocess_merge(df_mendan, df_oubo, excluded_mendan_cols=None, columns_to_drop=None, rename_map=None, compact=False)
+- add_time_deltas(df_merge_diff, df_mendan, df_oubo, vectorized=False, compact=False)
+- finalize_dataset(df_merge_diff, df_mendan, df_oubo, df_seiyaku, compact=False)
+- merge_bid(df_unique, df_seiyaku) -> df_unique with the 0/1 BID column
+- preprocess_merge_chunked(df_mendan, oubo_source, out_dir, chunksize=500_000, ..., dtype=None) -> list of parquet paths
 
 These functions aim to reproduce the notebook behavior in a modular way.
+compact=True converts high-repetition strings to category and downcasts
+numerics (see scripts.utils.compact_dtypes), skips defensive copies and logs
+the memory saved by each stage.
 """
 
+import os
+
 import pandas as pd
 import numpy as np
 
-
+from scripts.instrument import instrumented, span
+from scripts.utils import clear_parts, compact_dtypes, memory_usage_mb, report_memory
+
+
+# Defaults shared by the pandas stages and the alternative backends
+EXCLUDED_MENDAN_COLS = [
+    '人材担当', '求職者生年月日', '面談日時', '面談月', '面談週', '年齢帯', '★登録経路',
+    '面談カウント対象', '★経験職種', '面談フラグ', '面談所属判別用', '面談所属div',
+    '面談所属T', '面談予実用登録経路', '26期首都圏', '首都圏配布', '暫定用組織',
+    '★キックオフ用領域'
+]
+
+COLUMNS_TO_DROP = [
+    '求職者登録経路', '求職者生年月日', '年齢帯', '生年月日', '求職者年収帯', '★登録経路',
+    '登録経路.1', '6/16追加（土日祝日集計漏れ分）', '「1次面接設定中」のステータス登録日',
+    '最終面接日', '本人意思確認待ちステータス日付', '入社実績入力待ちステータス日付',
+    '求職者登録経路.1', 'エンエージェントジャッジ', '人材ランク_y', '面談週', 'EC書類提出日',
+    'コア経験職種_y', '進捗ID', '担当ECの所属部署', '担当ECの所属チーム', '担当EC',
+    '担当CPの所属部署', '担当CPの所属チーム', '「1次面接設定中」のステータス登録日',
+    '面談者', '人材担当の所属Div', '人材担当の所属チーム', '企業ID', '過去経験職種',
+    '求職者現在年収（単位：万円）', '面談日'
+]
+
+RENAME_MAP = {
+    '希望転職時期': '転職温度感',
+    '転職の温度感': '現在住所',
+    '現在年収（単位：万円）': '現在年収',
+    '職種カテゴリー': '職種',
+}
+
+# Date-like columns that may legitimately be empty, so they are excluded from the dropna subset
+DROPNA_EXCLUDED_COLS = ['企業書類提出日', '１次面接日', '求職者面談日時',
+                        '求人年収下限（単位：万円）', '求人年収上限（単位：万円）',
+                        '応募承諾月', '応募承諾週', 'データ登録日']
+
+
+@instrumented()
 def preprocess_merge(df_mendan: pd.DataFrame, df_oubo: pd.DataFrame,
-                     excluded_mendan_cols=None, columns_to_drop=None, rename_map=None):
+                     excluded_mendan_cols=None, columns_to_drop=None, rename_map=None, compact=False):
     """Merge df_oubo with a filtered df_mendan and apply initial column drops/renames.
 
+    compact=True drops the columns that would be dropped after the merge before
+    joining, and compacts both inputs before the join.
+
     Returns: df_merge_diff (DataFrame)
     """
     if excluded_mendan_cols is None:
-        excluded_mendan_cols = [
-            '人材担当', '求職者生年月日', '面談日時', '面談月', '面談週', '年齢帯', '★登録経路',
-            '面談カウント対象', '★経験職種', '面談フラグ', '面談所属判別用', '面談所属div',
-            '面談所属T', '面談予実用登録経路', '26期首都圏', '首都圏配布', '暫定用組織',
-            '★キックオフ用領域'
-        ]
+        excluded_mendan_cols = EXCLUDED_MENDAN_COLS
 
     # Keep 求職者ID always
     mendan_cols_to_keep = [col for col in df_mendan.columns if col not in excluded_mendan_cols or col == '求職者ID']
-    df_mendan_filtered = df_mendan[mendan_cols_to_keep].copy()
+    df_mendan_filtered = df_mendan[mendan_cols_to_keep]
+    if not compact:
+        df_mendan_filtered = df_mendan_filtered.copy()
+
+    if columns_to_drop is None:
+        columns_to_drop = COLUMNS_TO_DROP
+
+    if compact:
+        # Columns present on only one side keep their name through the merge, so they can be pruned up front
+        df_oubo = df_oubo.drop(columns=[c for c in columns_to_drop
+                                        if c in df_oubo.columns and c not in df_mendan_filtered.columns])
+        df_mendan_filtered = df_mendan_filtered.drop(columns=[c for c in columns_to_drop
+                                                              if c in df_mendan_filtered.columns
+                                                              and c not in df_oubo.columns and c != '求職者ID'])
+        before_mb = memory_usage_mb(df_oubo) + memory_usage_mb(df_mendan_filtered)
+        df_oubo = compact_dtypes(df_oubo)
+        df_mendan_filtered = compact_dtypes(df_mendan_filtered)
+        report_memory('preprocess_merge', before_mb, memory_usage_mb(df_oubo) + memory_usage_mb(df_mendan_filtered))
 
     df_merged = pd.merge(df_oubo, df_mendan_filtered, on='求職者ID', how='left')
 
-    if columns_to_drop is None:
-        columns_to_drop = [
-            '求職者登録経路', '求職者生年月日', '年齢帯', '生年月日', '求職者年収帯', '★登録経路',
-            '登録経路.1', '6/16追加（土日祝日集計漏れ分）', '「1次面接設定中」のステータス登録日',
-            '最終面接日', '本人意思確認待ちステータス日付', '入社実績入力待ちステータス日付',
-            '求職者登録経路.1', 'エンエージェントジャッジ', '人材ランク_y', '面談週', 'EC書類提出日',
-            'コア経験職種_y', '進捗ID', '担当ECの所属部署', '担当ECの所属チーム', '担当EC',
-            '担当CPの所属部署', '担当CPの所属チーム', '「1次面接設定中」のステータス登録日',
-            '面談者', '人材担当の所属Div', '人材担当の所属チーム', '企業ID', '過去経験職種',
-            '求職者現在年収（単位：万円）', '面談日'
-        ]
+    df_merge_diff = _clean_merged(df_merged, columns_to_drop, rename_map)
+    if not compact:
+        df_merge_diff = df_merge_diff.copy()
+
+    return df_merge_diff
+
 
+def _clean_merged(df_merged: pd.DataFrame, columns_to_drop, rename_map) -> pd.DataFrame:
     # Drop only existing columns
     df_merged = df_merged.drop(columns=[c for c in columns_to_drop if c in df_merged.columns])
 
     if rename_map is None:
-        rename_map = {
-            '希望転職時期': '転職温度感',
-            '転職の温度感': '現在住所',
-            '現在年収（単位：万円）': '現在年収',
-            '職種カテゴリー': '職種',
-        }
-
+        rename_map = RENAME_MAP
     df_merged = df_merged.rename(columns=rename_map)
 
     # Prepare dropna subset: exclude a few date columns from dropping
-    columns_to_exclude_from_dropna = ['企業書類提出日', '１次面接日', '求職者面談日時',
-                                      '求人年収下限（単位：万円）', '求人年収上限（単位：万円）',
-                                      '応募承諾月', '応募承諾週', 'データ登録日']
-
-    columns_for_dropna_subset = [col for col in df_merged.columns if col not in columns_to_exclude_from_dropna]
-    df_merge_diff = df_merged.dropna(subset=columns_for_dropna_subset).copy()
-
-    return df_merge_diff
-
+    columns_for_dropna_subset = [col for col in df_merged.columns if col not in DROPNA_EXCLUDED_COLS]
+    return df_merged.dropna(subset=columns_for_dropna_subset)
+
+
+def _iter_oubo_chunks(oubo_source, chunksize: int):
+    """Yield 応募 DataFrames from a CSV/parquet path or an iterable of DataFrames."""
+    if not isinstance(oubo_source, (str, os.PathLike)):
+        yield from oubo_source
+        return
+
+    if str(oubo_source).endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except Exception as e:
+            raise ImportError('pyarrow is required to stream parquet files: pip install pyarrow') from e
+        for batch in pq.ParquetFile(oubo_source).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(oubo_source, chunksize=chunksize)
+
+
+def _merge_part_dtypes(dtypes: dict, nullable: set, df: pd.DataFrame):
+    """Fold one chunk into the running column -> dtype map, as concatenating the chunks would.
+
+    Columns that are all-null in a chunk do not decide the dtype (they stay
+    None until a chunk holds values), numeric dtypes widen (int64 + float64 ->
+    float64) and mixed kinds fall back to str. nullable collects the columns
+    seen with missing values: those end up float64 when integer, like the
+    in-memory frame. object columns count as the dtype of their values.
+    """
+    for col in df.columns:
+        series = df[col]
+        if series.isna().any():
+            nullable.add(col)
+        if series.isna().all():
+            continue
+        dtype = series.infer_objects().dtype if series.dtype == object else series.dtype
+        current = dtypes.get(col)
+        if current is not None and current != dtype:
+            try:
+                dtype = np.result_type(current, dtype)
+            except TypeError:
+                dtype = object
+        # Mixed values cannot be written as one parquet column
+        dtypes[col] = pd.StringDtype(na_value=np.nan) if dtype == object else dtype
+
+
+def _part_dtypes(dtypes: dict, nullable: set, overrides: dict) -> dict:
+    """Dtypes the parts are written with: the merged dtypes, integers with missing values as float64, then overrides."""
+    resolved = {}
+    for col, dtype in dtypes.items():
+        if col in nullable and pd.api.types.is_integer_dtype(dtype):
+            dtype = np.dtype('float64')
+        resolved[col] = dtype
+    resolved.update(overrides or {})
+    return resolved
+
+
+@instrumented()
+def preprocess_merge_chunked(df_mendan: pd.DataFrame, oubo_source, out_dir: str, chunksize: int = 500_000,
+                             excluded_mendan_cols=None, columns_to_drop=None, rename_map=None, dtype=None):
+    """Streaming version of preprocess_merge for 応募 exports that do not fit in memory.
+
+    oubo_source is a CSV or parquet path (read chunksize rows at a time) or an
+    iterable of DataFrames. Each chunk is joined against a 求職者ID-indexed
+    面談 lookup, gets the same column drops / renames / dropna as
+    preprocess_merge, and is written to out_dir/part-NNNNN.parquet, so peak
+    memory is bounded by the chunk size plus the 面談 lookup. Parts of an
+    earlier run in out_dir are removed first.
+
+    Every part ends up with the same dtypes so the directory reads back as one
+    table: dtype (column -> dtype) where given, otherwise the dtypes the
+    in-memory preprocess_merge would give, inferred from the non-null values
+    of all chunks (see _merge_part_dtypes). A part written before a column's
+    dtype was known (e.g. a column that is empty in the first chunk) or
+    before it widened is rewritten at the end.
+
+    Returns: list of written parquet paths (read back with pd.read_parquet(out_dir)).
+    """
+    if excluded_mendan_cols is None:
+        excluded_mendan_cols = EXCLUDED_MENDAN_COLS
+    if columns_to_drop is None:
+        columns_to_drop = COLUMNS_TO_DROP
 
-def add_time_deltas(df_merge_diff: pd.DataFrame, df_mendan: pd.DataFrame, df_oubo: pd.DataFrame):
+    mendan_cols_to_keep = [col for col in df_mendan.columns if col not in excluded_mendan_cols or col == '求職者ID']
+    mendan_lookup = df_mendan[mendan_cols_to_keep].set_index('求職者ID')
+
+    clear_parts(out_dir)
+    paths = []
+    written_dtypes = []
+    merged_dtypes, nullable = {}, set()
+    for chunk in _iter_oubo_chunks(oubo_source, chunksize):
+        with span('preprocess_merge_chunked.chunk', chunk=len(paths), rows_in=len(chunk)) as current:
+            # Same _x/_y suffixes as pd.merge for columns present in both sheets
+            df_merged = chunk.join(mendan_lookup, on='求職者ID', how='left', lsuffix='_x', rsuffix='_y')
+            df_merge_diff = _clean_merged(df_merged, columns_to_drop, rename_map)
+            _merge_part_dtypes(merged_dtypes, nullable, df_merge_diff)
+            part_dtypes = _part_dtypes(merged_dtypes, nullable, dtype)
+            df_merge_diff = df_merge_diff.astype({col: t for col, t in part_dtypes.items()
+                                                  if col in df_merge_diff.columns})
+            current.set_output(df_merge_diff)
+
+            path = os.path.join(out_dir, f'part-{len(paths):05d}.parquet')
+            df_merge_diff.reset_index(drop=True).to_parquet(path, index=False)
+            paths.append(path)
+            # None: an all-null column written before its dtype was known (parquet null type)
+            written_dtypes.append({col: df_merge_diff[col].dtype if col in part_dtypes else None
+                                   for col in df_merge_diff.columns})
+
+    # Parts written before a column's final dtype was known
+    part_dtypes = _part_dtypes(merged_dtypes, nullable, dtype)
+    for path, written in zip(paths, written_dtypes):
+        stale = {col: t for col, t in part_dtypes.items() if col in written and (written[col] is None
+                                                                                 or written[col] != t)}
+        if stale:
+            with span('preprocess_merge_chunked.rewrite', path=path):
+                pd.read_parquet(path).astype(stale).to_parquet(path, index=False)
+
+    return paths
+
+
+@instrumented()
+def add_time_deltas(df_merge_diff: pd.DataFrame, df_mendan: pd.DataFrame, df_oubo: pd.DataFrame,
+                    vectorized: bool = False, compact: bool = False):
     """Add time delta columns used in the notebook.
 
     Ensures necessary date columns exist by merging when missing, then computes the four time-deltas.
+    vectorized=True clips negative deltas with Series.clip instead of a per-element lambda.
+    compact=True works on a shallow copy and downcasts the new day-delta columns.
     """
-    df_temp = df_merge_diff.copy()
+    df_temp = df_merge_diff.copy(deep=not compact)
 
     if 'データ登録日' not in df_temp.columns and 'データ登録日' in df_mendan.columns:
         df_temp = pd.merge(df_temp, df_mendan[['求職者ID', 'データ登録日']], on='求職者ID', how='left')
@@ -99,37 +262,62 @@ def add_time_deltas(df_merge_diff: pd.DataFrame, df_mendan: pd.DataFrame, df_oub
 
     time_diff_cols = ['登録→面談日数', '面談→応募承諾日数', '応募承諾→1面日数', '登録→応募承諾日数']
     for col in time_diff_cols:
-        if col in df_temp.columns:
+        if col in df_temp.columns and vectorized:
+            df_temp[col] = df_temp[col].clip(lower=0)
+            df_temp[col] = df_temp[col].fillna(0).astype(int)
+        elif col in df_temp.columns:
             df_temp[col] = df_temp[col].apply(lambda x: max(0, x) if pd.notna(x) else x)
             df_temp[col] = df_temp[col].fillna(0).astype(int)
 
+    if compact:
+        before_mb = memory_usage_mb(df_temp)
+        df_temp = compact_dtypes(df_temp)
+        report_memory('add_time_deltas', before_mb, memory_usage_mb(df_temp))
+
     return df_temp
 
 
-def finalize_dataset(df_merge_diff: pd.DataFrame, df_mendan: pd.DataFrame, df_oubo: pd.DataFrame, df_seiyaku: pd.DataFrame):
+def merge_bid(df_unique: pd.DataFrame, df_seiyaku: pd.DataFrame) -> pd.DataFrame:
+    """Left-merge the 0/1 BID flag from df_seiyaku (no-op when it has no 求職者ID / BID columns)."""
+    if {'求職者ID', 'BID'}.issubset(df_seiyaku.columns):
+        df_unique = pd.merge(df_unique, df_seiyaku[['求職者ID', 'BID']], on='求職者ID', how='left')
+        df_unique['BID'] = df_unique['BID'].fillna(0).astype(int)
+        df_unique['BID'] = df_unique['BID'].apply(lambda x: 1 if x != 0 else 0)
+    return df_unique
+
+
+@instrumented()
+def finalize_dataset(df_merge_diff: pd.DataFrame, df_mendan: pd.DataFrame, df_oubo: pd.DataFrame, df_seiyaku: pd.DataFrame,
+                     compact: bool = False):
     """Create unique per 求職者ID dataset, filter and merge BID from df_seiyaku.
 
     Filters: 現在年収 < 600, メイン紹介経路 == 'CP厳選', エントリー数 <= 100
+    The filters are combined into one mask so the frame is only sliced once.
     """
     # First create 求職者ID-unique dataset
-    df_unique = df_merge_diff.drop_duplicates(subset=['求職者ID'], keep='first').copy()
+    df_unique = df_merge_diff.drop_duplicates(subset=['求職者ID'], keep='first')
 
+    keep = pd.Series(True, index=df_unique.index)
     # Filter 年収 and 紹介経路
     if '現在年収' in df_unique.columns:
-        df_unique = df_unique[df_unique['現在年収'] < 600].copy()
+        keep &= df_unique['現在年収'] < 600
 
     if 'メイン紹介経路' in df_unique.columns:
-        df_unique = df_unique[df_unique['メイン紹介経路'] == 'CP厳選'].copy()
+        keep &= df_unique['メイン紹介経路'] == 'CP厳選'
 
     # Cap エントリー数 <= 100 if exists
     if 'エントリー数' in df_unique.columns:
-        df_unique = df_unique[df_unique['エントリー数'] <= 100].copy()
+        keep &= df_unique['エントリー数'] <= 100
 
-    # Merge BID
-    if {'求職者ID', 'BID'}.issubset(df_seiyaku.columns):
-        df_seiyaku_bid = df_seiyaku[['求職者ID', 'BID']].copy()
-        df_unique = pd.merge(df_unique, df_seiyaku_bid, on='求職者ID', how='left')
-        df_unique['BID'] = df_unique['BID'].fillna(0).astype(int)
-        df_unique['BID'] = df_unique['BID'].apply(lambda x: 1 if x != 0 else 0)
+    df_unique = df_unique[keep]
+    if not compact:
+        df_unique = df_unique.copy()
+
+    df_unique = merge_bid(df_unique, df_seiyaku)
+
+    if compact:
+        before_mb = memory_usage_mb(df_unique)
+        df_unique = compact_dtypes(df_unique)
+        report_memory('finalize_dataset', before_mb, memory_usage_mb(df_unique))
 
     return df_unique
@@ -0,0 +1,111 @@
+"""Persisted CV models and low-latency scoring of new candidates.
+
+A model bundle is a directory with preprocessor.json (the fit_preprocessor
+output: feature order, category labels, fill values) and one LightGBM text
+model per CV fold, truncated at the fold's best iteration. Scoring encodes
+candidates straight into a float array (no pandas round trip for dicts) and
+averages the fold boosters' probabilities.
+
+Functions:
+- save_model_bundle(models, preprocessor, bundle_dir) -> list of written paths
+- load_model_bundle(bundle_dir) -> bundle dict
+- encode_candidates(bundle, candidates) -> float ndarray (rows x features)
+- score_candidates(bundle, candidates) -> ndarray of BID probabilities
+"""
+
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+
+from scripts.model import label_string, transform_features
+from scripts.utils import model_booster
+
+
+def save_model_bundle(models, preprocessor: dict, bundle_dir: str):
+    """Write the fitted preprocessor and every fold model (train_lgb_cv output) to bundle_dir."""
+    if not isinstance(models, (list, tuple)):
+        models = [models]
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    paths = [os.path.join(bundle_dir, 'preprocessor.json')]
+    with open(paths[0], 'w', encoding='utf-8') as f:
+        json.dump(preprocessor, f, ensure_ascii=False, indent=2)
+
+    for fold, model in enumerate(models):
+        booster = model_booster(model)
+        path = os.path.join(bundle_dir, f'fold_{fold}.txt')
+        booster.save_model(path, num_iteration=booster.best_iteration or None)
+        paths.append(path)
+    return paths
+
+
+def load_model_bundle(bundle_dir: str) -> dict:
+    """Load a bundle: {'preprocessor', 'boosters', 'label_codes'} (label_codes: per-column label -> code)."""
+    with open(os.path.join(bundle_dir, 'preprocessor.json'), encoding='utf-8') as f:
+        preprocessor = json.load(f)
+
+    boosters = []
+    fold = 0
+    while os.path.exists(os.path.join(bundle_dir, f'fold_{fold}.txt')):
+        boosters.append(lgb.Booster(model_file=os.path.join(bundle_dir, f'fold_{fold}.txt')))
+        fold += 1
+    if not boosters:
+        raise FileNotFoundError(f'no fold_N.txt models in {bundle_dir}')
+
+    label_codes = {col: {label: code for code, label in enumerate(labels)}
+                   for col, labels in preprocessor['categorical'].items()}
+    return {'preprocessor': preprocessor, 'boosters': boosters, 'label_codes': label_codes}
+
+
+def _encode_value(value, col, bundle):
+    codes = bundle['label_codes'].get(col)
+    if codes is not None:
+        # Same labels as fit_preprocessor (missing values included); unseen labels are missing
+        return codes.get(label_string(value), math.nan)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = math.nan
+    if math.isnan(number):
+        fill_value = bundle['preprocessor']['numerical'][col]
+        return math.nan if fill_value is None else fill_value
+    return number
+
+
+def _category_codes(series: pd.Series) -> np.ndarray:
+    codes = series.cat.codes.to_numpy(dtype=float)
+    codes[codes < 0] = np.nan
+    return codes
+
+
+def encode_candidates(bundle: dict, candidates) -> np.ndarray:
+    """Encode a candidate dict, a list of dicts or a DataFrame into the model's feature array.
+
+    Missing keys are treated as missing values. The categorical columns hold
+    the label codes that prepare_lgb_data produced, so the array can be
+    passed to the boosters directly.
+    """
+    features = bundle['preprocessor']['features']
+    if isinstance(candidates, pd.DataFrame):
+        X = transform_features(candidates.reindex(columns=features), bundle['preprocessor'])
+        columns = [_category_codes(X[col]) if col in bundle['label_codes'] else X[col].to_numpy(dtype=float)
+                   for col in features]
+        return np.column_stack(columns).reshape(len(X), len(features))
+
+    if isinstance(candidates, dict):
+        candidates = [candidates]
+    return np.array([[_encode_value(record.get(col), col, bundle) for col in features] for record in candidates],
+                    dtype=float).reshape(len(candidates), len(features))
+
+
+def score_candidates(bundle: dict, candidates) -> np.ndarray:
+    """Average BID probability of the bundle's fold models for one candidate (dict) or a batch."""
+    X = encode_candidates(bundle, candidates)
+    probabilities = np.zeros(len(X))
+    for booster in bundle['boosters']:
+        probabilities += booster.predict(X)
+    return probabilities / len(bundle['boosters'])
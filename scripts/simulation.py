@@ -0,0 +1,207 @@
+"""Monte Carlo simulation of the lift from a distribution policy.
+
+Each scenario draws a random cohort of candidates from df_final (with
+replacement), routes it with every policy and samples entries (Poisson) and
+BIDs (Bernoulli) from per-(candidate, CP) rates. All policies of a scenario
+share the same cohort and the same uniforms for the BID draws, so their
+difference is the lift and not sampling noise. Scenarios are simulated in NumPy batches, each batch
+with its own SeedSequence child, so results do not depend on n_jobs.
+
+Functions:
+- policy_assignments(df_final, policies, bid_proba, cp_names) -> dict of policy -> CP position per candidate
+- simulate_policies(df_final, bid_proba, cp_names, policies, n_scenarios=1000, ...) -> per-scenario DataFrame or parquet paths
+- summarize_simulation(results, baseline='current', alpha=0.05) -> DataFrame of mean, CI of the mean and
+  scenario percentile range per policy
+"""
+
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from scripts.instrument import instrumented
+from scripts.utils import clear_parts, resolve_n_jobs
+
+
+RESULT_COLUMNS = ['scenario', 'policy', 'entries', 'bids']
+
+# Set once per worker process by _init_worker, so batches do not re-send the matrices
+_WORKER = {}
+
+
+def policy_assignments(df_final: pd.DataFrame, policies, bid_proba, cp_names):
+    """Resolve policies into a CP position (column of bid_proba) per candidate.
+
+    A policy is one of:
+    - 'current': the 担当CP in df_final (CPs not in cp_names -> -1)
+    - 'best': the CP with the highest BID probability
+    - 'random': a uniformly random CP, drawn anew in every scenario (kept as 'random')
+    - an int array of CP positions per candidate, e.g. assign_candidates output (-1 = not routed)
+    policies may be a list of names or a dict {name: policy}.
+    """
+    if not isinstance(policies, dict):
+        policies = {policy: policy for policy in policies}
+
+    assignments = {}
+    for name, policy in policies.items():
+        if isinstance(policy, str) and policy == 'current':
+            cp_pos = {cp: j for j, cp in enumerate(cp_names)}
+            assignments[name] = df_final['担当CP'].map(cp_pos).fillna(-1).to_numpy(dtype=int)
+        elif isinstance(policy, str) and policy == 'best':
+            assignments[name] = np.asarray(bid_proba).argmax(axis=1)
+        elif isinstance(policy, str) and policy == 'random':
+            assignments[name] = 'random'
+        elif isinstance(policy, str):
+            raise ValueError(f"unknown policy '{policy}'")
+        else:
+            assignment = np.asarray(policy, dtype=int)
+            if assignment.shape != (len(df_final),):
+                raise ValueError(f"policy '{name}' must give one CP position per candidate")
+            assignments[name] = assignment
+    return assignments
+
+
+def _default_entry_rate(df_final: pd.DataFrame, cp_names):
+    """Mean エントリー数 of each CP's candidates, the same for every candidate."""
+    if 'エントリー数' not in df_final.columns or '担当CP' not in df_final.columns:
+        return np.zeros(len(cp_names))
+    per_cp = df_final.groupby('担当CP', observed=True)['エントリー数'].mean()
+    return per_cp.reindex(cp_names).fillna(df_final['エントリー数'].mean()).to_numpy(dtype=float)
+
+
+def _init_worker(bid_proba, entry_rate, assignments):
+    # A trailing zero column absorbs the -1 (not routed) positions
+    n_candidates = bid_proba.shape[0]
+    _WORKER['bid_proba'] = np.hstack([bid_proba, np.zeros((n_candidates, 1))])
+    _WORKER['entry_rate'] = np.hstack([entry_rate, np.zeros((entry_rate.shape[0], 1))])
+    _WORKER['assignments'] = assignments
+
+
+def _simulate_batch(seed, first_scenario, n_scenarios, cohort_size):
+    """Simulate n_scenarios scenarios at once; returns totals per (scenario, policy)."""
+    bid_proba, entry_rate, assignments = _WORKER['bid_proba'], _WORKER['entry_rate'], _WORKER['assignments']
+    n_candidates, n_cps = bid_proba.shape[0], bid_proba.shape[1] - 1
+    rng = np.random.default_rng(seed)
+
+    cohort = rng.integers(0, n_candidates, size=(n_scenarios, cohort_size))
+    # Shared random numbers: the same uniforms decide the outcome under every policy
+    uniforms = rng.random((n_scenarios, cohort_size))
+    random_cps = rng.integers(0, n_cps, size=(n_scenarios, cohort_size))
+
+    frames = []
+    for name, assignment in assignments.items():
+        cps = random_cps if isinstance(assignment, str) else assignment[cohort]
+        cps = np.where(cps < 0, n_cps, cps)
+        bids = (uniforms < bid_proba[cohort, cps]).sum(axis=1)
+        rate = entry_rate[cohort, cps] if entry_rate.shape[0] == n_candidates else entry_rate[0, cps]
+        entries = rng.poisson(rate).sum(axis=1)
+        frames.append(pd.DataFrame({
+            'scenario': np.arange(first_scenario, first_scenario + n_scenarios),
+            'policy': name,
+            'entries': entries,
+            'bids': bids,
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def _run_batch(args):
+    seed, first_scenario, n_scenarios, cohort_size, out_path = args
+    result = _simulate_batch(seed, first_scenario, n_scenarios, cohort_size)
+    if out_path is None:
+        return result
+    result.to_parquet(out_path, index=False)
+    return out_path
+
+
+@instrumented()
+def simulate_policies(df_final: pd.DataFrame, bid_proba, cp_names, policies=('current', 'best', 'random'),
+                      n_scenarios=1000, cohort_size=None, batch_size=100, entry_rate=None, seed=42,
+                      n_jobs=1, out_dir=None):
+    """Simulate n_scenarios redistributions of df_final under every policy.
+
+    bid_proba: (candidates x CPs) BID probabilities, e.g. from
+        distribution.bid_probability_matrix with the fitted fold models.
+    cp_names: the CPs of the bid_proba columns.
+    policies: see policy_assignments.
+    cohort_size: candidates per scenario (default: len(df_final)).
+    entry_rate: expected エントリー数 per CP (length CPs) or per (candidate, CP);
+        default is each CP's mean エントリー数 in df_final.
+    n_jobs: worker processes (-1 = all cores); the same seed gives the same
+        scenarios for any n_jobs.
+    out_dir: write each batch to out_dir/part-NNNNN.parquet as soon as it is
+        done and return the paths, so large sweeps never sit in memory. Parts
+        of an earlier run in out_dir are removed first.
+
+    Returns a DataFrame with scenario, policy, entries and bids (or the paths).
+    """
+    bid_proba = np.asarray(bid_proba, dtype=float)
+    if bid_proba.shape != (len(df_final), len(cp_names)):
+        raise ValueError('bid_proba must have one row per candidate and one column per CP')
+    if entry_rate is None:
+        entry_rate = _default_entry_rate(df_final, cp_names)
+    entry_rate = np.atleast_2d(np.asarray(entry_rate, dtype=float))
+    assignments = policy_assignments(df_final, policies, bid_proba, cp_names)
+    cohort_size = len(df_final) if cohort_size is None else cohort_size
+
+    starts = np.arange(0, n_scenarios, batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    if out_dir is not None:
+        clear_parts(out_dir)
+    tasks = [(seeds[i], int(start), int(min(batch_size, n_scenarios - start)), cohort_size,
+              None if out_dir is None else os.path.join(out_dir, f'part-{i:05d}.parquet'))
+             for i, start in enumerate(starts)]
+
+    n_workers = min(resolve_n_jobs(n_jobs), len(tasks))
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(bid_proba, entry_rate, assignments)) as executor:
+            results = list(executor.map(_run_batch, tasks))
+    else:
+        _init_worker(bid_proba, entry_rate, assignments)
+        results = [_run_batch(task) for task in tasks]
+        _WORKER.clear()
+
+    if out_dir is not None:
+        return results
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=RESULT_COLUMNS)
+
+
+def summarize_simulation(results, baseline='current', alpha=0.05) -> pd.DataFrame:
+    """Mean, confidence interval of the mean and scenario range of entries, bids and the lift per policy.
+
+    <metric>_ci_low / _ci_high: (1 - alpha) normal-approximation confidence
+    interval of the expected value (mean +- z * sd / sqrt(n_scenarios)).
+    <metric>_pi_low / _pi_high: (alpha/2, 1-alpha/2) percentiles of the
+    individual scenarios, i.e. the range a single day's batch falls in.
+    results: simulate_policies output, a list of its parquet paths or the out_dir.
+    The lift is each scenario's bids minus the baseline policy's bids in the
+    same scenario (omitted when baseline is None or not simulated).
+    """
+    if isinstance(results, str):
+        results = sorted(glob.glob(os.path.join(results, 'part-*.parquet')))
+    if not isinstance(results, pd.DataFrame):
+        results = pd.concat([pd.read_parquet(path) for path in results], ignore_index=True)
+
+    wide = results.pivot(index='scenario', columns='policy', values=['entries', 'bids'])
+    policies = list(pd.unique(results['policy']))
+    quantiles = [alpha / 2, 1 - alpha / 2]
+    z = stats.norm.ppf(1 - alpha / 2)
+
+    rows = []
+    for policy in policies:
+        row = {'policy': policy, 'n_scenarios': int(wide['bids'][policy].notna().sum())}
+        metrics = {'entries': wide['entries'][policy], 'bids': wide['bids'][policy]}
+        if baseline is not None and baseline in policies:
+            metrics['lift'] = wide['bids'][policy] - wide['bids'][baseline]
+        for metric, values in metrics.items():
+            mean = values.mean()
+            half_width = z * values.std() / np.sqrt(values.count())
+            low, high = values.quantile(quantiles)
+            row.update({f'{metric}_mean': mean,
+                        f'{metric}_ci_low': mean - half_width, f'{metric}_ci_high': mean + half_width,
+                        f'{metric}_pi_low': low, f'{metric}_pi_high': high})
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,149 @@
+"""Compiled CP strength index for routing lookups.
+
+Compiles run_mannwhitney_tests output into a CSR layout keyed by
+(feature, category): for key k, positions indptr[k]:indptr[k + 1] of cp_ids /
+effect_size / p_value hold the strong CPs ranked by effect size. The arrays
+are saved as .npy files (loaded with mmap_mode='r') next to a JSON file with
+the CP names and the (feature, category) -> key map, so a saved index opens
+without reading the arrays into memory.
+
+Functions:
+- build_strength_index(strengths, p_threshold=0.05, cp_names=None) -> index dict
+- save_strength_index(index, index_dir) / load_strength_index(index_dir, mmap=True)
+- lookup_strengths(index, feature, category) -> DataFrame of ranked CPs
+- candidate_scores(index, df_candidates) -> csr_matrix (candidates x CPs) of summed effect sizes
+- top_cps(index, df_candidates, k=3) -> DataFrame of the k best CPs per candidate
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+ARRAYS = ['indptr', 'cp_ids', 'effect_size', 'p_value']
+
+
+def _category_key(value) -> str:
+    # The scipy engine returns numeric categories as floats (3.0), candidate columns hold 3
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def build_strength_index(strengths: pd.DataFrame, p_threshold=0.05, cp_names=None) -> dict:
+    """Compile the significant rows (p_value < p_threshold; None keeps all) of run_mannwhitney_tests output.
+
+    cp_names fixes the CP order of the scores (default: order of appearance);
+    rows of other CPs are left out.
+    """
+    rows = strengths if p_threshold is None else strengths[strengths['p_value'] < p_threshold]
+    if cp_names is None:
+        cp_names = list(pd.unique(strengths['CP']))
+    cp_pos = {cp: j for j, cp in enumerate(cp_names)}
+    rows = rows[rows['CP'].isin(cp_pos)]
+
+    category_keys = [_category_key(c) for c in rows['Category']]
+    key_frame = pd.DataFrame({'Feature': rows['Feature'].to_numpy(), 'key': category_keys})
+    pairs = key_frame.drop_duplicates().sort_values(['Feature', 'key']).reset_index(drop=True)
+    key_ids = pd.MultiIndex.from_frame(pairs).get_indexer(pd.MultiIndex.from_frame(key_frame))
+
+    # Group by key, strongest effect first
+    effect_size = rows['effect_size'].to_numpy(dtype=float)
+    order = np.lexsort((-effect_size, key_ids))
+    keys = {}
+    for key_id, (feature, category) in enumerate(zip(pairs['Feature'], pairs['key'])):
+        keys.setdefault(str(feature), {})[category] = key_id
+
+    return {
+        'cp_names': list(cp_names),
+        'keys': keys,
+        'indptr': np.concatenate([[0], np.cumsum(np.bincount(key_ids, minlength=len(pairs)))]).astype(np.int64),
+        'cp_ids': rows['CP'].map(cp_pos).to_numpy(dtype=np.int32)[order],
+        'effect_size': effect_size[order].astype(np.float32),
+        'p_value': rows['p_value'].to_numpy(dtype=float)[order].astype(np.float32),
+    }
+
+
+def save_strength_index(index: dict, index_dir: str):
+    os.makedirs(index_dir, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(index_dir, f'{name}.npy'), index[name])
+    with open(os.path.join(index_dir, 'keys.json'), 'w', encoding='utf-8') as f:
+        json.dump({'cp_names': index['cp_names'], 'keys': index['keys']}, f, ensure_ascii=False, default=str)
+
+
+def load_strength_index(index_dir: str, mmap: bool = True) -> dict:
+    """Load a saved index; with mmap=True the arrays are memory-mapped read-only."""
+    with open(os.path.join(index_dir, 'keys.json'), encoding='utf-8') as f:
+        index = json.load(f)
+    for name in ARRAYS:
+        index[name] = np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r' if mmap else None)
+    return index
+
+
+def lookup_strengths(index: dict, feature, category) -> pd.DataFrame:
+    """CPs strong for (feature, category), strongest first."""
+    key_id = index['keys'].get(str(feature), {}).get(_category_key(category))
+    if key_id is None:
+        return pd.DataFrame(columns=['CP', 'effect_size', 'p_value'])
+    start, end = index['indptr'][key_id], index['indptr'][key_id + 1]
+    return pd.DataFrame({
+        'CP': np.asarray(index['cp_names'], dtype=object)[index['cp_ids'][start:end]],
+        'effect_size': np.asarray(index['effect_size'][start:end], dtype=float),
+        'p_value': np.asarray(index['p_value'][start:end], dtype=float),
+    })
+
+
+def candidate_scores(index: dict, df_candidates: pd.DataFrame):
+    """Sum of the effect sizes of every (candidate, CP) over the candidate's (feature, category) keys.
+
+    Built as (candidates x keys indicator) @ (keys x CPs CSR matrix); the CSR
+    matrix wraps the index arrays directly.
+    """
+    n_keys = len(index['indptr']) - 1
+    weights = sparse.csr_matrix((index['effect_size'], index['cp_ids'], index['indptr']),
+                                shape=(n_keys, len(index['cp_names'])))
+
+    rows, cols = [], []
+    for feature, lookup in index['keys'].items():
+        if feature not in df_candidates.columns:
+            continue
+        # Map each distinct value once, then broadcast through the factorized codes
+        codes, uniques = pd.factorize(df_candidates[feature])
+        unique_keys = np.array([lookup.get(_category_key(u), -1) for u in uniques] + [-1], dtype=np.int64)
+        key_ids = unique_keys[codes]
+        matched = np.flatnonzero(key_ids >= 0)
+        rows.append(matched)
+        cols.append(key_ids[matched])
+
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=np.int64)
+    indicator = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                                  shape=(len(df_candidates), n_keys))
+    return (indicator @ weights).tocsr()
+
+
+def top_cps(index: dict, df_candidates: pd.DataFrame, k: int = 3) -> pd.DataFrame:
+    """The k CPs with the highest positive score per candidate (long format: 求職者ID, rank, 担当CP, score)."""
+    scores = candidate_scores(index, df_candidates).toarray()
+    k = min(k, scores.shape[1])
+    if k == 0 or len(scores) == 0:
+        return pd.DataFrame(columns=['求職者ID', 'rank', '担当CP', 'score'])
+
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best = np.take_along_axis(best, order, axis=1)
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+    candidate, rank = np.nonzero(best_scores > 0)
+    ids = df_candidates['求職者ID'].to_numpy() if '求職者ID' in df_candidates.columns else df_candidates.index.to_numpy()
+    return pd.DataFrame({
+        '求職者ID': ids[candidate],
+        'rank': rank + 1,
+        '担当CP': np.asarray(index['cp_names'], dtype=object)[best[candidate, rank]],
+        'score': best_scores[candidate, rank].astype(float),
+    })
@@ -0,0 +1,125 @@
+"""Synthetic 面談 / 応募 / 成約 sheets for development and benchmarks.
+
+The frames have the columns that preprocess_merge, add_time_deltas,
+create_features and finalize_dataset read (plus a few of the columns they
+drop), with cardinalities in the range of the real exports. Every column is
+drawn with vectorized NumPy calls, so 10M 応募 rows take seconds rather than
+minutes.
+
+Functions:
+- generate_sheets(n_oubo=10_000, n_candidates=None, n_cps=60, bid_rate=0.1, seed=0) -> (df_mendan, df_oubo, df_seiyaku)
+"""
+
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+
+INDUSTRIES = ['IT・通信', 'メーカー', '金融', '小売・流通', 'メディカル', '建設・不動産', '商社', 'サービス',
+              'コンサルティング', '人材', '広告・メディア', 'インフラ']
+JOB_TYPES = ['営業', 'ITエンジニア', '事務・アシスタント', '企画・マーケティング', '販売・サービス', '経理・財務',
+             '人事・総務', '機械・電気エンジニア', 'クリエイティブ', 'コンサルタント']
+RANKS = ['S', 'A', 'B', 'C', 'D']
+REFERRAL_ROUTES = ['CP厳選', '求人応募', 'スカウト', '自己応募']
+REGISTRATION_ROUTES = ['Web（スカウト）', 'Web（新規会員）', 'Web（案件応募）', 'アプリ（新規会員）', '紹介', '提携媒体']
+TIMINGS = ['すぐにでも', '3ヶ月以内', '6ヶ月以内', '1年以内', '未定']
+PREFECTURES = ['東京都', '神奈川県', '埼玉県', '千葉県', '大阪府', '愛知県', '福岡県']
+
+
+def _comma_lists(rng, values, max_items, size, sep=', '):
+    """Comma-separated lists of 1..max_items distinct values, drawn from all such lists."""
+    lists = np.array([sep.join(combo) for k in range(1, max_items + 1) for combo in combinations(values, k)],
+                     dtype=object)
+    # Shorter lists are more common, as in the real 経験業種 / コア経験職種 fields
+    sizes = np.array([len(s.split(sep)) for s in lists])
+    weights = 1.0 / sizes ** 3
+    return lists[rng.choice(len(lists), size=size, p=weights / weights.sum())]
+
+
+def _pick(rng, values, size, p=None):
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=size, p=p)]
+
+
+def generate_sheets(n_oubo=10_000, n_candidates=None, n_cps=60, bid_rate=0.1, seed=0):
+    """Generate (df_mendan, df_oubo, df_seiyaku) with n_oubo 応募 rows.
+
+    n_candidates: distinct 求職者ID (default n_oubo // 5, about five 応募 per
+        candidate; 応募 counts are skewed, so a few candidates have dozens).
+    n_cps: number of 担当CP; CPs differ in their base BID rate and in the
+        industry where they convert best, so the BID model has signal.
+    bid_rate: approximate share of candidates with a 成約 row.
+    """
+    rng = np.random.default_rng(seed)
+    if n_candidates is None:
+        n_candidates = max(n_oubo // 5, 1)
+    base = np.datetime64('2024-04-01')
+
+    # 面談シート: one row per candidate
+    ids = np.arange(1_000_000, 1_000_000 + n_candidates)
+    registered = base + rng.integers(0, 730, n_candidates).astype('timedelta64[D]')
+    interviewed = registered + rng.integers(-2, 45, n_candidates).astype('timedelta64[D]')
+    cps = np.array([f'CP{i:04d}' for i in range(n_cps)], dtype=object)
+    candidate_cp = rng.integers(0, n_cps, n_candidates)
+    candidate_rank = rng.choice(len(RANKS), n_candidates, p=[0.05, 0.2, 0.4, 0.25, 0.1])
+    salary = np.round(rng.lognormal(np.log(420), 0.3, n_candidates)).clip(200, 1500)
+
+    df_mendan = pd.DataFrame({
+        '求職者ID': ids,
+        'データ登録日': registered,
+        '求職者面談日時': interviewed,
+        '面談日時': interviewed,
+        '人材担当': _pick(rng, [f'RA{i:03d}' for i in range(max(n_cps // 3, 1))], n_candidates),
+        '転職回数': rng.choice([0, 1, 2, 3, 4, 5, np.nan], n_candidates, p=[0.3, 0.3, 0.18, 0.1, 0.05, 0.02, 0.05]),
+        '人材ランク': np.asarray(RANKS, dtype=object)[candidate_rank],
+        'コア経験職種': _comma_lists(rng, JOB_TYPES, 2, n_candidates, sep=','),
+        '経験業種': _comma_lists(rng, INDUSTRIES, 3, n_candidates),
+        '登録経路': _pick(rng, REGISTRATION_ROUTES + [None], n_candidates, p=[0.25, 0.3, 0.2, 0.1, 0.05, 0.05, 0.05]),
+        '希望転職時期': _pick(rng, TIMINGS, n_candidates),
+        '転職の温度感': _pick(rng, PREFECTURES, n_candidates, p=[0.35, 0.15, 0.1, 0.1, 0.15, 0.1, 0.05]),
+        '現在年収（単位：万円）': salary,
+    })
+
+    # 応募シート: skewed number of 応募 per candidate
+    activity = rng.gamma(0.8, size=n_candidates)
+    owner = rng.choice(n_candidates, size=n_oubo, p=activity / activity.sum())
+    owner.sort(kind='stable')
+    accepted = interviewed[owner] + rng.integers(0, 90, n_oubo).astype('timedelta64[D]')
+    first_interview = accepted + rng.integers(3, 30, n_oubo).astype('timedelta64[D]')
+    first_interview[rng.random(n_oubo) < 0.6] = np.datetime64('NaT')
+    salary_low = np.round(rng.normal(400, 80, n_oubo) / 10) * 10
+    n_jobs = max(n_oubo // 3, 1)
+
+    df_oubo = pd.DataFrame({
+        '求職者ID': ids[owner],
+        '進捗ID': np.arange(n_oubo),
+        '求人ID': rng.integers(0, n_jobs, n_oubo),
+        '企業': pd.Categorical.from_codes(rng.integers(0, max(n_jobs // 10, 1), n_oubo),
+                                        [f'企業{i:06d}' for i in range(max(n_jobs // 10, 1))]).astype(object),
+        '業種': _pick(rng, INDUSTRIES, n_oubo),
+        '職種カテゴリー': _pick(rng, JOB_TYPES, n_oubo),
+        '案件ランク': _pick(rng, RANKS, n_oubo, p=[0.1, 0.25, 0.35, 0.2, 0.1]),
+        '人材ランク': np.asarray(RANKS, dtype=object)[candidate_rank[owner]],
+        'コア経験職種': _pick(rng, JOB_TYPES, n_oubo),
+        '求人年収下限（単位：万円）': np.where(rng.random(n_oubo) < 0.05, np.nan, salary_low),
+        '求人年収上限（単位：万円）': salary_low + np.round(rng.uniform(50, 350, n_oubo) / 10) * 10,
+        '紹介経路': _pick(rng, REFERRAL_ROUTES, n_oubo, p=[0.6, 0.2, 0.12, 0.08]),
+        '担当CP': cps[candidate_cp[owner]],
+        '担当EC': _pick(rng, [f'EC{i:03d}' for i in range(max(n_cps // 2, 1))], n_oubo),
+        '応募承諾週': accepted,
+        '１次面接日': first_interview,
+    })
+
+    # 成約シート: BID depends on the CP, the candidate rank and a CP-specific strong industry
+    cp_effect = rng.normal(0, 0.5, n_cps)
+    strong_industry = rng.integers(0, len(INDUSTRIES), n_cps)
+    experienced = df_mendan['経験業種']
+    strong = np.zeros(n_candidates, dtype=bool)
+    for k, industry in enumerate(INDUSTRIES):
+        selected = strong_industry[candidate_cp] == k
+        strong[selected] = experienced[selected].str.contains(industry, regex=False).to_numpy()
+    logit = np.log(bid_rate / (1 - bid_rate)) + cp_effect[candidate_cp] + 0.3 * (2 - candidate_rank) + 0.8 * strong
+    has_bid = rng.random(n_candidates) < 1 / (1 + np.exp(-logit))
+    df_seiyaku = pd.DataFrame({'求職者ID': ids[has_bid], 'BID': 1})
+
+    return df_mendan, df_oubo, df_seiyaku
@@ -1,20 +1,59 @@
 """Statistical tests (Mann-Whitney U) utilities.
 
-Function:
-- run_mannwhitney_tests(filtered_cp_dataframes_list, features_to_test)
+Functions:
+- run_mannwhitney_tests(filtered_cp_dataframes_list, features_to_test, engine='scipy', n_jobs=1)
+- add_resampling_stats(results, filtered_cp_dataframes_list, n_boot=1000, n_perm=1000, alpha=0.05, random_state=42)
+- benjamini_hochberg(p_values) -> BH/FDR q-values
 
 Returns a DataFrame with statistical results similar to the original notebook.
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
 import pandas as pd
 import numpy as np
+from scipy.special import ndtr
 from scipy.stats import mannwhitneyu
 
+from scripts.instrument import instrumented, iter_spans, span
+from scripts.utils import resolve_n_jobs
+
+
+RESULT_COLUMNS = ['CP', 'Feature', 'Category', 'Mean_Entries_in_Category', 'p_value', 'effect_size',
+                  'Overall_Mean_Entries_for_CP', 'Sample_Count_in_Category']
+
+
+def _cp_fields(df_cp):
+    return {'cp': df_cp['担当CP'].iloc[0] if len(df_cp) else None, 'rows_in': len(df_cp)}
+
+
+@instrumented()
+def run_mannwhitney_tests(filtered_cp_dataframes_list, features_to_test, engine='scipy', n_jobs=1):
+    """Compare エントリー数 of each high-performing category against the rest of its CP.
+
+    engine='scipy' calls scipy.stats.mannwhitneyu per (CP, feature, category).
+    engine='batched' ranks エントリー数 once per CP and reads every U statistic off
+    grouped rank sums; it returns the same schema and the same p-values
+    (scipy's tie-corrected normal approximation, or scipy itself in the rare
+    small-sample no-ties case where scipy would use the exact distribution).
+
+    n_jobs > 1 (or -1 for all cores) splits the CP list into contiguous chunks
+    and runs them in a process pool; results are concatenated in the input
+    order, so the output is the same as a single-process run.
+    """
+    n_workers = min(resolve_n_jobs(n_jobs), len(filtered_cp_dataframes_list))
+    if n_workers > 1:
+        return _run_mannwhitney_parallel(filtered_cp_dataframes_list, features_to_test, engine, n_workers)
+
+    if engine == 'batched':
+        return _run_mannwhitney_batched(filtered_cp_dataframes_list, features_to_test)
+    if engine != 'scipy':
+        raise ValueError(f"engine must be 'scipy' or 'batched', got {engine!r}")
 
-def run_mannwhitney_tests(filtered_cp_dataframes_list, features_to_test):
     results = []
 
-    for df_cp in filtered_cp_dataframes_list:
+    for df_cp in iter_spans('run_mannwhitney_tests.cp', filtered_cp_dataframes_list, _cp_fields):
         if df_cp.empty:
             continue
         cp_name = df_cp['担当CP'].iloc[0]
@@ -24,7 +63,7 @@ def run_mannwhitney_tests(filtered_cp_dataframes_list, features_to_test):
             if feature not in df_cp.columns:
                 continue
 
-            feature_stats = df_cp.groupby(feature)['エントリー数'].agg(mean_entries='mean', sample_count='count').reset_index()
+            feature_stats = df_cp.groupby(feature, observed=True)['エントリー数'].agg(mean_entries='mean', sample_count='count').reset_index()
 
             high_performing_categories = feature_stats[(feature_stats['mean_entries'] >= 1.1 * overall_mean_entries) & (feature_stats['sample_count'] >= 4)]
 
@@ -66,3 +105,198 @@ def run_mannwhitney_tests(filtered_cp_dataframes_list, features_to_test):
                     })
 
     return pd.DataFrame(results)
+
+
+def _run_mannwhitney_parallel(filtered_cp_dataframes_list, features_to_test, engine, n_workers):
+    # A few chunks per worker keeps the pool busy when CP sizes are uneven
+    n_chunks = min(len(filtered_cp_dataframes_list), n_workers * 4)
+    bounds = np.linspace(0, len(filtered_cp_dataframes_list), n_chunks + 1).astype(int)
+    chunks = [filtered_cp_dataframes_list[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        partial_results = list(executor.map(run_mannwhitney_tests, chunks, repeat(features_to_test), repeat(engine)))
+
+    partial_results = [r for r in partial_results if not r.empty]
+    if not partial_results:
+        return pd.DataFrame()
+    return pd.concat(partial_results, ignore_index=True)
+
+
+def _run_mannwhitney_batched(filtered_cp_dataframes_list, features_to_test):
+    frames = [df_cp for df_cp in filtered_cp_dataframes_list if not df_cp.empty]
+    features = [f for f in features_to_test if any(f in df_cp.columns for df_cp in frames)]
+    if not frames or not features:
+        return pd.DataFrame()
+
+    cp_names = np.array([df_cp['担当CP'].iloc[0] for df_cp in frames], dtype=object)
+    overall_means = np.array([df_cp['エントリー数'].mean() for df_cp in frames])
+    cp_sizes = np.array([len(df_cp) for df_cp in frames])
+
+    columns = ['エントリー数'] + features
+    data = pd.concat([df_cp[[c for c in columns if c in df_cp.columns]] for df_cp in frames], ignore_index=True)
+    data['_cp'] = np.repeat(np.arange(len(frames)), cp_sizes)
+
+    # Rank once per CP; the tie term only depends on the CP's エントリー数 distribution
+    data['_rank'] = data.groupby('_cp')['エントリー数'].rank(method='average')
+    tie_sizes = data.groupby(['_cp', 'エントリー数']).size()
+    t = tie_sizes.to_numpy(dtype=float)
+    tie_cp = tie_sizes.index.get_level_values('_cp').to_numpy()
+    tie_term = np.bincount(tie_cp, weights=t ** 3 - t, minlength=len(frames))
+    has_ties = np.bincount(tie_cp, weights=(t > 1), minlength=len(frames)) > 0
+
+    tables = []
+    for feature_pos, feature in enumerate(features):
+        with span('run_mannwhitney_tests.feature', feature=feature, rows_in=len(data)):
+            stats = data.groupby(['_cp', feature], observed=True).agg(
+                mean_entries=('エントリー数', 'mean'),
+                sample_count=('エントリー数', 'count'),
+                n1=('エントリー数', 'size'),
+                rank_sum=('_rank', 'sum'),
+            ).reset_index()
+            cp = stats['_cp'].to_numpy()
+            stats['n2'] = cp_sizes[cp] - stats['n1'].to_numpy()
+            keep = ((stats['mean_entries'] >= 1.1 * overall_means[cp]) & (stats['sample_count'] >= 4)
+                    & (stats['n1'] > 1) & (stats['n2'] > 1))
+            stats = stats[keep].rename(columns={feature: 'Category'})
+            stats['Feature'] = feature
+            stats['_feature_pos'] = feature_pos
+            tables.append(stats)
+
+    stats = pd.concat(tables, ignore_index=True)
+    if stats.empty:
+        return pd.DataFrame()
+    stats = stats.sort_values(['_cp', '_feature_pos'], kind='stable').reset_index(drop=True)
+
+    cp = stats['_cp'].to_numpy()
+    n1 = stats['n1'].to_numpy(dtype=float)
+    n2 = stats['n2'].to_numpy(dtype=float)
+    N = n1 + n2
+    U1 = stats['rank_sum'].to_numpy(dtype=float) - n1 * (n1 + 1) / 2
+
+    # Two-sided, tie- and continuity-corrected normal approximation, as in scipy
+    mu = n1 * n2 / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(n1 * n2 / 12 * ((N + 1) - tie_term[cp] / (N * (N - 1))))
+        z = (np.maximum(U1, n1 * n2 - U1) - mu - 0.5) / s
+    p_values = np.clip(2 * ndtr(-z), 0.0, 1.0)
+
+    # scipy switches to the exact distribution for small samples without ties
+    exact = ((n1 <= 8) | (n2 <= 8)) & ~has_ties[cp]
+    for i in np.flatnonzero(exact):
+        df_cp = frames[cp[i]]
+        in_category = (df_cp[stats.at[i, 'Feature']] == stats.at[i, 'Category']).to_numpy()
+        entries = df_cp['エントリー数'].to_numpy()
+        p_values[i] = mannwhitneyu(entries[in_category], entries[~in_category], alternative='two-sided').pvalue
+
+    # Effect size r from the untied normal approximation (same as the per-test loop)
+    std_U = np.sqrt(n1 * n2 * (N + 1) / 12)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        effect_size_r = np.where(std_U != 0, (U1 - mu) / std_U / np.sqrt(N),
+                                 np.where(U1 == mu, 0.0, np.nan))
+
+    return pd.DataFrame({
+        'CP': cp_names[cp],
+        'Feature': stats['Feature'].to_numpy(),
+        'Category': stats['Category'].to_numpy(dtype=object),
+        'Mean_Entries_in_Category': stats['mean_entries'].to_numpy(),
+        'p_value': p_values,
+        'effect_size': effect_size_r,
+        'Overall_Mean_Entries_for_CP': overall_means[cp],
+        'Sample_Count_in_Category': stats['sample_count'].to_numpy(),
+    }, columns=RESULT_COLUMNS)
+
+
+def benjamini_hochberg(p_values):
+    """Benjamini-Hochberg q-values (FDR-adjusted p-values); NaN p-values stay NaN."""
+    p_values = np.asarray(p_values, dtype=float)
+    q_values = np.full(p_values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    if len(valid) == 0:
+        return q_values
+
+    order = valid[np.argsort(p_values[valid], kind='stable')]
+    m = len(order)
+    adjusted = p_values[order] * m / np.arange(1, m + 1)
+    q_values[order] = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1.0)
+    return q_values
+
+
+@instrumented()
+def add_resampling_stats(results, filtered_cp_dataframes_list, n_boot=1000, n_perm=1000, alpha=0.05,
+                         random_state=42):
+    """Add bootstrap CIs, permutation p-values and BH q-values to run_mannwhitney_tests output.
+
+    New columns:
+    - lift: mean エントリー数 in the category minus the rest of the CP
+    - lift_ci_low / lift_ci_high, effect_size_ci_low / effect_size_ci_high:
+      percentile bootstrap intervals, resampling each group with replacement
+    - perm_p_value: two-sided permutation p-value of U with the CP's ranks fixed
+    - q_value: Benjamini-Hochberg q-value of p_value over all tests
+
+    All tests of a CP share one batch of resamples: bootstrap draws are
+    multinomial counts over the CP's distinct エントリー数 values (the
+    histogram of a resample index matrix), and every permutation is a
+    shuffled rank vector scored against all category masks by one matrix
+    product.
+    """
+    results = results.copy()
+    n_tests = len(results)
+    columns = {name: np.full(n_tests, np.nan) for name in
+               ['lift', 'lift_ci_low', 'lift_ci_high', 'effect_size_ci_low', 'effect_size_ci_high', 'perm_p_value']}
+    if n_tests == 0:
+        for name, values in columns.items():
+            results[name] = values
+        results['q_value'] = benjamini_hochberg(results.get('p_value', []))
+        return results
+
+    frames = {df_cp['担当CP'].iloc[0]: df_cp for df_cp in filtered_cp_dataframes_list if not df_cp.empty}
+    rng = np.random.default_rng(random_state)
+    quantiles = [alpha / 2, 1 - alpha / 2]
+
+    for cp_name, rows in results.groupby('CP', sort=False).indices.items():
+        df_cp = frames.get(cp_name)
+        if df_cp is None:
+            continue
+        with span('add_resampling_stats.cp', cp=cp_name, rows_in=len(df_cp), n_tests=len(rows)):
+            entries = df_cp['エントリー数'].to_numpy(dtype=float)
+            masks = np.column_stack([(df_cp[feature] == category).to_numpy()
+                                     for feature, category in zip(results['Feature'].to_numpy()[rows],
+                                                                  results['Category'].to_numpy()[rows])])
+            n1 = masks.sum(axis=0)
+            n2 = len(entries) - n1
+            N = n1 + n2
+
+            # Bootstrap: per-test histograms over the distinct values, for both groups
+            values, codes = np.unique(entries, return_inverse=True)
+            hist_a = np.stack([np.bincount(codes[masks[:, t]], minlength=len(values)) for t in range(len(rows))])
+            hist_b = np.bincount(codes, minlength=len(values))[None, :] - hist_a
+            boot_a = rng.multinomial(n1, hist_a / n1[:, None], size=(n_boot, len(rows)))
+            boot_b = rng.multinomial(n2, hist_b / n2[:, None], size=(n_boot, len(rows)))
+
+            lift = boot_a @ values / n1 - boot_b @ values / n2
+            # U = sum over group a of (#b below + half #b tied), read off the b histogram
+            below_b = np.cumsum(boot_b, axis=2) - boot_b
+            U = (boot_a * (below_b + 0.5 * boot_b)).sum(axis=2)
+            mu = n1 * n2 / 2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                effect_size = (U - mu) / np.sqrt(n1 * n2 * (N + 1) / 12) / np.sqrt(N)
+
+            columns['lift'][rows] = entries @ masks / n1 - entries @ ~masks / n2
+            columns['lift_ci_low'][rows], columns['lift_ci_high'][rows] = np.quantile(lift, quantiles, axis=0)
+            columns['effect_size_ci_low'][rows], columns['effect_size_ci_high'][rows] = np.nanquantile(
+                effect_size, quantiles, axis=0)
+
+            # Permutation: shuffled ranks (n_perm x N) @ category masks (N x tests) -> rank sums
+            ranks = pd.Series(entries).rank(method='average').to_numpy()
+            observed = np.abs(ranks @ masks - n1 * (N + 1) / 2)
+            shuffled = np.take_along_axis(np.broadcast_to(ranks, (n_perm, len(ranks))),
+                                          rng.random((n_perm, len(ranks))).argsort(axis=1), axis=1)
+            permuted = np.abs(shuffled @ masks - n1 * (N + 1) / 2)
+            # A small tolerance so rank sums equal to the observed one count as extreme
+            extreme = (permuted >= observed - 1e-9).sum(axis=0)
+            columns['perm_p_value'][rows] = (extreme + 1) / (n_perm + 1)
+
+    for name, values in columns.items():
+        results[name] = values
+    results['q_value'] = benjamini_hochberg(results['p_value'])
+    return results
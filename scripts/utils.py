@@ -1,24 +1,126 @@
 """Utility helpers for notebook refactor.
 
 Functions:
+- cp_row_indices(df, min_rows=10, max_rows=200) -> dict of 担当CP -> positional row indices
 - split_by_cp(df, min_rows=10, max_rows=200) -> list of DataFrames
+- resolve_n_jobs(n_jobs) -> number of worker processes
+- compact_dtypes(df, category_ratio=0.5, keep_object=('求職者ID',)) -> df with compact dtypes
+- memory_usage_mb(df) -> deep memory usage in MB
+- report_memory(stage, before_mb, after_mb) -> logs the memory saved by a stage
+- clear_parts(out_dir) -> removes the part-*.parquet files left by an earlier run
+- model_booster(model) -> the lgb.Booster of an LGBMClassifier (or the Booster itself)
+- frame_hash(df) -> sha256 hex digest of a DataFrame's dtypes and values
 """
 
+import glob
+import hashlib
+import logging
+import os
+
+import numpy as np
 import pandas as pd
 
+from scripts.instrument import instrumented
+
+
+logger = logging.getLogger(__name__)
+
+
+def cp_row_indices(df: pd.DataFrame, min_rows: int = 10, max_rows: int = 200):
+    """Return {担当CP: positional row indices} for CPs with min_rows <= rows < max_rows.
+
+    Built from a single groupby pass, so it costs O(rows) regardless of the
+    number of CPs. CPs keep their order of first appearance.
+    """
+    if '担当CP' not in df.columns:
+        return {}
+
+    indices = df.groupby('担当CP', sort=False, observed=True).indices
+    return {cp: idx for cp, idx in indices.items() if min_rows <= len(idx) < max_rows}
 
+
+@instrumented()
 def split_by_cp(df: pd.DataFrame, min_rows: int = 10, max_rows: int = 200):
     """Return a list of DataFrames, one per 担当CP, filtered by row counts.
 
     Keeps CPs with min_rows <= rows < max_rows.
     """
-    result = []
-    if '担当CP' not in df.columns:
-        return result
-
-    unique_cps = df['担当CP'].dropna().unique()
-    for cp in unique_cps:
-        df_cp = df[df['担当CP'] == cp].copy()
-        if len(df_cp) >= min_rows and len(df_cp) < max_rows:
-            result.append(df_cp)
-    return result
+    return [df.take(idx) for idx in cp_row_indices(df, min_rows, max_rows).values()]
+
+
+def resolve_n_jobs(n_jobs: int) -> int:
+    """Translate an n_jobs argument (-1 = all cores) into a worker count."""
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+def compact_dtypes(df: pd.DataFrame, category_ratio: float = 0.5, keep_object=('求職者ID',)) -> pd.DataFrame:
+    """Return df with high-repetition strings as category and numerics downcast.
+
+    - object/string columns whose distinct count is at most category_ratio * rows
+      become category (columns in keep_object are left alone)
+    - integer columns are downcast to the smallest integer type that fits
+    - float columns become float32 only when that is lossless
+    Columns that are already compact are not touched, so calling this at every
+    stage only converts the columns the stage added.
+    """
+    converted = {}
+    for col in df.columns:
+        series = df[col]
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(dtype):
+            continue
+        if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            if col in keep_object or len(series) == 0:
+                continue
+            if series.nunique(dropna=True) <= category_ratio * len(series):
+                converted[col] = series.astype('category')
+        elif pd.api.types.is_integer_dtype(dtype):
+            downcast = pd.to_numeric(series, downcast='integer')
+            if downcast.dtype != dtype:
+                converted[col] = downcast
+        elif pd.api.types.is_float_dtype(dtype) and dtype != np.float32:
+            values = series.to_numpy()
+            values32 = values.astype(np.float32)
+            if np.array_equal(values32.astype(values.dtype), values, equal_nan=True):
+                converted[col] = pd.Series(values32, index=series.index, name=col)
+
+    if not converted:
+        return df
+    df = df.copy(deep=False)
+    for col, series in converted.items():
+        df[col] = series
+    return df
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    """Deep memory usage of df in MB."""
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def report_memory(stage: str, before_mb: float, after_mb: float):
+    """Log the memory a compact stage saved."""
+    logger.info('%s: %.1f MB -> %.1f MB (saved %.1f MB)', stage, before_mb, after_mb, before_mb - after_mb)
+
+
+def clear_parts(out_dir: str):
+    """Create out_dir and remove the part-*.parquet files an earlier run left in it."""
+    os.makedirs(out_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(out_dir, 'part-*.parquet')):
+        os.remove(path)
+
+
+def model_booster(model):
+    """The lgb.Booster behind an LGBMClassifier; Boosters are returned as is."""
+    return model.booster_ if hasattr(model, 'booster_') else model
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    """Content hash of df (column names, dtypes, index and values), e.g. for cache keys."""
+    digest = hashlib.sha256()
+    digest.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,20 @@
+import pandas as pd
+
+from scripts.benchmark import BASELINE_PATH, STAGES, compare_to_baseline, load_baseline
+
+
+def test_committed_baseline_covers_every_stage():
+    baseline = load_baseline(BASELINE_PATH)
+    assert set(baseline['stages']) == set(STAGES)
+    assert baseline['meta']['scale'] == 10_000
+    assert baseline['environment']['pandas']
+
+
+def test_slower_stage_is_flagged_against_the_baseline():
+    baseline = load_baseline(BASELINE_PATH)
+    results = pd.DataFrame([{'stage': stage, 'seconds': values['seconds'], 'peak_mb': values['peak_mb']}
+                            for stage, values in baseline['stages'].items()])
+    results.loc[results['stage'] == 'train_lgb_cv', 'seconds'] *= 2
+
+    comparison = compare_to_baseline(results, baseline, tolerance=0.25).set_index('stage')
+    assert comparison['regression'].tolist() == [stage == 'train_lgb_cv' for stage in comparison.index]
@@ -0,0 +1,19 @@
+import pandas as pd
+
+from scripts.feature_engineering import create_features
+from scripts.preprocessing import add_time_deltas, preprocess_merge
+from scripts.synthetic import generate_sheets
+
+
+def test_vectorized_features_match_row_wise():
+    df_mendan, df_oubo, _ = generate_sheets(n_oubo=2000, n_candidates=400, seed=0)
+    df_merge_diff = preprocess_merge(df_mendan, df_oubo)
+
+    frames = {}
+    for vectorized in (False, True):
+        df = add_time_deltas(df_merge_diff, df_mendan, df_oubo, vectorized=vectorized)
+        frames[vectorized, 'add_time_deltas'] = df
+        frames[vectorized, 'create_features'] = create_features(df, vectorized=vectorized)
+
+    for stage in ('add_time_deltas', 'create_features'):
+        pd.testing.assert_frame_equal(frames[True, stage], frames[False, stage])
@@ -0,0 +1,27 @@
+import pandas as pd
+
+from scripts.incremental import compact_state, load_dataset, refresh_dataset
+from scripts.pipeline import build_final_dataset
+from scripts.synthetic import generate_sheets
+
+
+def test_refresh_matches_full_rebuild(tmp_path):
+    df_mendan, df_oubo, df_seiyaku = generate_sheets(n_oubo=3000, n_candidates=600, seed=0)
+
+    # A candidate that passes the filters on the first refresh and is filtered out by a later delta
+    first = df_oubo.iloc[:2000]
+    kept = build_final_dataset(df_mendan, first, df_seiyaku)['求職者ID'].iloc[0]
+    extra = pd.concat([df_oubo[df_oubo['求職者ID'] == kept].iloc[[0]]] * 120, ignore_index=True)
+    extra['紹介経路'] = '求人応募'
+    df_oubo = pd.concat([df_oubo, extra], ignore_index=True)
+
+    state_dir = str(tmp_path / 'state')
+    for start, end in [(0, 2000), (2000, 2500), (2500, len(df_oubo))]:
+        refreshed = refresh_dataset(state_dir, df_mendan, df_oubo.iloc[start:end], df_seiyaku)
+
+    expected = build_final_dataset(df_mendan, df_oubo, df_seiyaku, vectorized=True).reset_index(drop=True)
+    assert kept not in set(expected['求職者ID'])
+    pd.testing.assert_frame_equal(refreshed, expected)
+
+    compact_state(state_dir)
+    pd.testing.assert_frame_equal(load_dataset(state_dir, df_seiyaku), expected)
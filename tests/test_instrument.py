@@ -0,0 +1,22 @@
+from scripts.instrument import InMemoryRecorder, iter_spans, recording, span
+
+
+def test_iter_spans_is_a_pass_through_without_a_recorder():
+    calls = []
+    assert list(iter_spans('loop', [1, 2], lambda item: calls.append(item) or {})) == [1, 2]
+    assert calls == []
+
+
+def test_abandoned_iter_spans_do_not_become_parents():
+    recorder = InMemoryRecorder()
+    with recording(recorder):
+        with span('outer'):
+            items = iter_spans('loop', [1, 2])
+            next(items)
+        with span('after'):
+            pass
+        items.close()
+
+    parents = {event['name']: event['parent'] for event in recorder.events}
+    assert parents['after'] is None
+    assert parents['loop'] == 'outer'
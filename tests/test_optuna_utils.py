@@ -0,0 +1,30 @@
+import numpy as np
+import optuna
+import pandas as pd
+
+from scripts.optuna_utils import optuna_search
+
+
+class AlwaysPrune(optuna.pruners.BasePruner):
+    def prune(self, study, trial):
+        return True
+
+
+def _data():
+    rng = np.random.default_rng(0)
+    n = 200
+    X = pd.DataFrame({'現在年収': rng.normal(450, 80, n), 'エントリー数': rng.poisson(5, n).astype(float)})
+    Y = pd.Series((rng.random(n) < 0.3).astype(int))
+    return X, Y
+
+
+def test_workers_use_the_callers_pruner(tmp_path):
+    X, Y = _data()
+    states = {}
+    for n_jobs in (1, 2):
+        study = optuna_search(X, Y, [], n_trials=6, n_splits=2, pruner=AlwaysPrune(),
+                              storage=str(tmp_path / f'journal-{n_jobs}.log'), n_jobs=n_jobs)
+        states[n_jobs] = sorted(trial.state.name for trial in study.get_trials(deepcopy=False))
+
+    assert states[1] == ['PRUNED'] * 6
+    assert states[2] == states[1]
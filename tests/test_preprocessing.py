@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+from scripts.preprocessing import preprocess_merge, preprocess_merge_chunked
+from scripts.synthetic import generate_sheets
+
+
+def test_chunked_parts_match_preprocess_merge(tmp_path):
+    df_mendan, df_oubo, _ = generate_sheets(n_oubo=400, n_candidates=80, seed=0)
+    # The first chunk has no 求人年収下限 / １次面接日 values at all
+    df_oubo.loc[:49, ['求人年収下限（単位：万円）', '１次面接日']] = np.nan
+    csv_path = str(tmp_path / 'oubo.csv')
+    df_oubo.to_csv(csv_path, index=False)
+
+    out_dir = str(tmp_path / 'parts')
+    preprocess_merge_chunked(df_mendan, csv_path, out_dir, chunksize=50)
+
+    expected = preprocess_merge(df_mendan, pd.read_csv(csv_path)).reset_index(drop=True)
+    # Parquet has no second resolution, so datetime64[s] columns read back as [ms]
+    expected = expected.astype({col: 'datetime64[ms]' for col in expected.columns
+                                if expected[col].dtype == 'datetime64[s]'})
+    pd.testing.assert_frame_equal(pd.read_parquet(out_dir), expected)
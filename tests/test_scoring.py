@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from scripts.model import prepare_lgb_data, train_lgb_cv
+from scripts.scoring import load_model_bundle, save_model_bundle, score_candidates
+
+
+FEATURES = ['業種', '担当CP', '現在年収']
+
+
+def _bundle(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 400
+    df = pd.DataFrame({
+        '業種': rng.choice(['IT', 'メーカー', '商社', None], n).astype(object),
+        '担当CP': rng.choice(['CP1', 'CP2', 'CP3'], n).astype(object),
+        '現在年収': rng.normal(450, 80, n),
+    })
+    df['BID'] = (rng.random(n) < np.where(df['業種'].isna(), 0.5, 0.1)).astype(int)
+
+    X, Y, categorical_features, _, preprocessor = prepare_lgb_data(df, FEATURES, return_preprocessor=True)
+    models, _ = train_lgb_cv(X, Y, categorical_features,
+                             params={'n_estimators': 30, 'min_child_samples': 5, 'verbose': -1})
+    save_model_bundle(models, preprocessor, str(tmp_path))
+    return load_model_bundle(str(tmp_path))
+
+
+def test_missing_categories_score_the_same_for_dicts_and_frames(tmp_path):
+    bundle = _bundle(tmp_path)
+    records = [
+        {'業種': None, '担当CP': 'CP1', '現在年収': 400.0},
+        {'業種': np.nan, '担当CP': 'CP2', '現在年収': 500.0},
+        {'担当CP': 'CP3', '現在年収': 450.0},
+        {'業種': 'IT', '担当CP': 'CP1', '現在年収': 420.0},
+    ]
+    frame = pd.DataFrame(records, columns=FEATURES)
+
+    from_dicts = score_candidates(bundle, records)
+    from_frame = score_candidates(bundle, frame)
+
+    np.testing.assert_allclose(from_dicts, from_frame)
+    # The three missing 業種 rows use the trained missing label, not an unseen one
+    label_codes = bundle['label_codes']['業種']
+    assert 'nan' in label_codes and 'None' not in label_codes
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from scripts.pipeline import FEATURES_TO_TEST, build_final_dataset
+from scripts.synthetic import generate_sheets
+from scripts.u_test import run_mannwhitney_tests
+from scripts.utils import split_by_cp
+
+
+def _cp_frames():
+    df_mendan, df_oubo, df_seiyaku = generate_sheets(n_oubo=20000, n_candidates=3000, n_cps=12, seed=0)
+    frames = split_by_cp(build_final_dataset(df_mendan, df_oubo, df_seiyaku), min_rows=10, max_rows=10_000)
+
+    # Small CP without ties: scipy uses the exact distribution here
+    frames.append(pd.DataFrame({
+        '担当CP': 'CP_small',
+        'エントリー数': [11, 12, 9, 10, 1, 2, 3, 4, 5, 6, 7, 8],
+        '業種': ['IT・通信'] * 4 + ['メーカー'] * 8,
+        '職種': ['営業', '事務・アシスタント'] * 6,
+    }))
+    return frames
+
+
+def _u_statistic(results, frames):
+    """U of each row, recovered from the effect size r = (U - n1 * n2 / 2) / std_U / sqrt(N)."""
+    sizes = {df_cp['担当CP'].iloc[0]: len(df_cp) for df_cp in frames}
+    N = results['CP'].map(sizes).to_numpy(dtype=float)
+    n1 = results['Sample_Count_in_Category'].to_numpy(dtype=float)
+    n2 = N - n1
+    return results['effect_size'].to_numpy() * np.sqrt(N) * np.sqrt(n1 * n2 * (N + 1) / 12) + n1 * n2 / 2
+
+
+def _assert_same_tests(actual, expected, frames):
+    pd.testing.assert_frame_equal(actual[['CP', 'Feature', 'Sample_Count_in_Category']],
+                                  expected[['CP', 'Feature', 'Sample_Count_in_Category']], check_dtype=False)
+    assert actual['Category'].astype(str).tolist() == expected['Category'].astype(str).tolist()
+    np.testing.assert_allclose(_u_statistic(actual, frames), _u_statistic(expected, frames))
+    np.testing.assert_allclose(actual['p_value'], expected['p_value'], rtol=1e-9)
+    np.testing.assert_allclose(actual['effect_size'], expected['effect_size'], rtol=1e-9)
+
+
+def test_batched_engine_matches_scipy():
+    frames = _cp_frames()
+    expected = run_mannwhitney_tests(frames, FEATURES_TO_TEST, engine='scipy')
+    assert 'CP_small' in set(expected['CP'])
+
+    _assert_same_tests(run_mannwhitney_tests(frames, FEATURES_TO_TEST, engine='batched'), expected, frames)
+
+
+def test_parallel_run_matches_single_process():
+    frames = _cp_frames()
+    for engine in ('scipy', 'batched'):
+        expected = run_mannwhitney_tests(frames, FEATURES_TO_TEST, engine=engine, n_jobs=1)
+        _assert_same_tests(run_mannwhitney_tests(frames, FEATURES_TO_TEST, engine=engine, n_jobs=2), expected, frames)